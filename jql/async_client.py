@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import Executor, ThreadPoolExecutor
+import functools
+import logging
+from typing import Any, Callable, List, Optional, TypeVar, TYPE_CHECKING
+
+from jql.client import Client
+from jql.types import Fact, Item
+
+if TYPE_CHECKING:
+    from jql.store import Store
+
+
+T = TypeVar('T')
+
+
+class AsyncClient:
+    """
+    Asyncio facade over Client.
+
+    Queries run on a dedicated executor, so the event loop is never blocked
+    by store work. Any number of queries can be awaited at once, they queue
+    on the executor and run max_workers at a time. The store does its own
+    locking, so a SqliteStore in WAL mode will serve reads in parallel.
+    """
+    def __init__(self, store: 'Store', client: str, log_level: int = logging.INFO, max_workers: int = 4, executor: Optional[Executor] = None):
+        self.client = Client(store=store, client=client, log_level=log_level)
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='jql')
+
+    @property
+    def store(self) -> 'Store':
+        return self.client.store
+
+    async def _run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def read(self, query: str) -> List[Item]:
+        return await self._run(self.client.read, query)
+
+    async def get_item(self, ref: Fact, as_of: Optional[Fact] = None) -> Optional[Item]:
+        return await self._run(self.store.get_item, ref, as_of=as_of)
+
+    async def get_items(self, search: List[Fact], limit: Optional[int] = None, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> List[Item]:
+        return await self._run(self.store.get_items, search, limit=limit, after=after, as_of=as_of)
+
+    async def close(self) -> None:
+        # Only shut down an executor we created, a shared one is the caller's
+        if self._own_executor:
+            await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+
+    async def __aenter__(self) -> 'AsyncClient':
+        return self
+
+    async def __aexit__(self, *exc: Any) -> None:
+        await self.close()
@@ -1,11 +1,18 @@
 from dataclasses import dataclass
 import datetime
-from typing import Any, Dict, List, Set
+import hashlib
+from sys import intern
+from typing import Any, Dict, Iterable, List, Set, Tuple
 
 
 from jql.types import Fact, fact_from_dict
 
 
+# Binary formats, for changes alone and for whole changesets
+CHANGES_MAGIC = b'JQc\x01'
+CHANGESET_MAGIC = b'JQC\x01'
+
+
 @dataclass()
 class Change:
     facts: Set[Fact]
@@ -40,9 +47,174 @@ class ChangeSet:
     applied: bool = False
     replicated: bool = False
 
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'uuid': self.uuid,
+            'client': self.client,
+            'origin': self.origin,
+            'origin_rowid': self.origin_rowid,
+            'created': str(self.created),
+            'query': self.query,
+            'changes': self.changes_as_dict(),
+            'applied': self.applied,
+            'replicated': self.replicated
+        }
+
+    @classmethod
+    def from_dict(cls, c: Dict[str, Any]) -> 'ChangeSet':
+        return ChangeSet(
+            uuid=c['uuid'],
+            client=c['client'],
+            origin=c['origin'],
+            origin_rowid=int(c['origin_rowid']),
+            created=datetime.datetime.fromisoformat(c['created']),
+            query=c['query'],
+            changes=cls.changes_from_dict(c['changes']),
+            applied=bool(c.get('applied', False)),
+            replicated=bool(c.get('replicated', False))
+        )
+
     def changes_as_dict(self) -> List[Dict[str, Any]]:
-        return sorted([c.to_dict() for c in self.changes], key=repr)
+        # Changes keep their order, later changes to an item win
+        return [c.to_dict() for c in self.changes]
 
     @classmethod
     def changes_from_dict(cls, changes: List[Dict[str, Any]]) -> List[Change]:
         return [Change.from_dict(c) for c in changes]
+
+    def to_bytes(self) -> bytes:
+        """
+        Compact, deterministic binary encoding of the changeset (without the
+        local applied/replicated flags)
+        """
+        return self._encode(self.origin_rowid)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'ChangeSet':
+        reader = _Reader(data, CHANGESET_MAGIC)
+        uuid, client, origin = reader.str(), reader.str(), reader.str()
+        origin_rowid = reader.int()
+        created, query = reader.str(), reader.str()
+        return ChangeSet(
+            uuid=uuid,
+            client=client,
+            origin=origin,
+            origin_rowid=origin_rowid,
+            created=datetime.datetime.fromisoformat(created),
+            query=query,
+            changes=reader.changes(),
+        )
+
+    def content_hash(self) -> str:
+        """
+        SHA-256 of the binary encoding, leaving out origin_rowid so the hash
+        is the same on every store the changeset reaches
+        """
+        return hashlib.sha256(self._encode(0)).hexdigest()
+
+    def _encode(self, origin_rowid: int) -> bytes:
+        writer = _Writer(CHANGESET_MAGIC)
+        writer.str(self.uuid)
+        writer.str(self.client)
+        writer.str(self.origin)
+        writer.int(origin_rowid)
+        writer.str(str(self.created))
+        writer.str(self.query)
+        writer.changes(self.changes)
+        return bytes(writer.out)
+
+
+def encode_changes(changes: Iterable[Change]) -> bytes:
+    writer = _Writer(CHANGES_MAGIC)
+    writer.changes(changes)
+    return bytes(writer.out)
+
+
+def decode_changes(data: bytes) -> List[Change]:
+    return _Reader(data, CHANGES_MAGIC).changes()
+
+
+class _Writer:
+    """
+    Strings are written as a varint of their UTF-8 length and the bytes, or
+    as a varint back reference to an identical earlier string, so repeated
+    tags, props and uuids are only stored once. Facts are sorted, so the
+    same changes always encode the same way.
+    """
+    def __init__(self, magic: bytes) -> None:
+        self.out = bytearray(magic)
+        self._strings: Dict[str, int] = {}
+
+    def int(self, n: int) -> None:
+        out = self.out
+        while n >= 0x80:
+            out.append((n & 0x7f) | 0x80)
+            n >>= 7
+        out.append(n)
+
+    def str(self, s: str) -> None:
+        idx = self._strings.get(s)
+        if idx is not None:
+            self.int(idx << 1 | 1)
+            return
+        self._strings[s] = len(self._strings)
+        data = s.encode('utf-8')
+        self.int(len(data) << 1)
+        self.out += data
+
+    def changes(self, changes: Iterable[Change]) -> None:
+        changes = list(changes)
+        self.int(len(changes))
+        for change in changes:
+            self.str(change.uuid)
+            self.int(int(change.revoke))
+            facts: List[Tuple[str, str, str]] = sorted(f.as_tuple() for f in change.facts)
+            self.int(len(facts))
+            for tag, prop, value in facts:
+                self.str(tag)
+                self.str(prop)
+                self.str(value)
+
+
+class _Reader:
+    def __init__(self, data: bytes, magic: bytes) -> None:
+        if data[:len(magic)] != magic:
+            raise Exception('Unrecognised changeset encoding')
+        self._data = data
+        self._pos = len(magic)
+        self._strings: List[str] = []
+
+    def int(self) -> int:
+        data = self._data
+        b = data[self._pos]
+        self._pos += 1
+        if b < 0x80:
+            return b
+        n = b & 0x7f
+        shift = 7
+        while True:
+            b = data[self._pos]
+            self._pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def str(self) -> str:
+        n = self.int()
+        if n & 1:
+            return self._strings[n >> 1]
+        start = self._pos
+        self._pos = start + (n >> 1)
+        s = intern(self._data[start:self._pos].decode('utf-8')) if n < 128 else self._data[start:self._pos].decode('utf-8')
+        self._strings.append(s)
+        return s
+
+    def changes(self) -> List[Change]:
+        changes = []
+        for _ in range(self.int()):
+            uuid = self.str()
+            revoke = bool(self.int())
+            facts = {Fact(self.str(), self.str(), self.str()) for _ in range(self.int())}
+            changes.append(Change(facts=facts, uuid=uuid, revoke=revoke))
+        return changes
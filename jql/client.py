@@ -1,16 +1,21 @@
 import logging
+import os
 import structlog
 from structlog.stdlib import LoggerFactory
 import sys
 from typing import List, TYPE_CHECKING
 
-from gevent import monkey  # type: ignore
-monkey.patch_all()
+# Monkey patching for gevent is opt-in, as it slows down imports and isn't
+# needed unless replication is running in the background
+if os.getenv('GEVENT', False) is not False:
+    from gevent import monkey  # type: ignore
+    monkey.patch_all()
 
 
 if TYPE_CHECKING:
     from jql.store import Store
 
+from jql.prepared import PreparedQuery  # noqa: E402
 from jql.types import Item  # noqa: E402
 from jql.transaction import Transaction  # noqa: E402
 
@@ -49,3 +54,9 @@ class Client:
 
     def read(self, query: str) -> List[Item]:
         return self.new_transaction().q(query)
+
+    def run_script(self, script: str) -> List[Item]:
+        return self.new_transaction().script(script)
+
+    def prepare(self, query: str) -> PreparedQuery:
+        return PreparedQuery(self, query)
@@ -1,12 +1,35 @@
+from functools import lru_cache
 from pathlib import Path
+import re
+from typing import List, Optional, Tuple, Union
 
 from lark import Lark, Transformer, Token, Tree, v_args  # type: ignore
+from lark.exceptions import VisitError
 
 from jql.types import Fact, Ref, Tag, Flag, Value, Content
 
 
 grammar_file = Path(__file__).parent / 'jql.lark'
-jql_parser = Lark(open(grammar_file), parser='lalr', start='action')
+# cache=True stores the built LALR tables in the temp dir, keyed on the
+# grammar and Lark version, so later imports load them instead of rebuilding
+jql_parser = Lark(grammar_file.read_text(), parser='lalr', start='action', cache=True)
+
+
+def is_match(fact: Fact) -> bool:
+    """
+    Marks the start of the search terms of a SET, DEL or ARCHIVE on every
+    match, its value is the number of terms
+    """
+    return fact.tag == '_db' and fact.prop == 'match'
+
+
+# _db props the parser generates for search and paging, never typed by users
+RESERVED = ('match', 'limit', 'after', 'as_of', 'as_of_time')
+
+
+def check_reserved(tag: str, prop: Optional[str]) -> None:
+    if tag == '_db' and prop in RESERVED:
+        raise Exception(f'Query error: #_db/{prop} is reserved')
 
 
 class JqlTransformer(Transformer[Tree]):  # type: ignore
@@ -20,16 +43,39 @@ class JqlTransformer(Transformer[Tree]):  # type: ignore
 
     @v_args(inline=True)  # type: ignore
     def fact(self, f: Fact, i: Token) -> Fact:
+        check_reserved(f.tag, i.value)
         return Flag(f.tag, i.value)
 
     @v_args(inline=True)  # type: ignore
     def value(self, f: Fact, i: Token) -> Fact:
         return Value(f.tag, f.prop, i.value)
 
+    @v_args(inline=True)  # type: ignore
+    def search(self, *terms: Fact) -> List[Fact]:
+        return [Value('_db', 'match', str(len(terms))), *terms]
+
+    @v_args(inline=True)  # type: ignore
+    def limit(self, i: Token) -> Fact:
+        return Value('_db', 'limit', i.value)
+
+    @v_args(inline=True)  # type: ignore
+    def after(self, ref: Fact) -> Fact:
+        return Value('_db', 'after', ref.value)
+
+    @v_args(inline=True)  # type: ignore
+    def as_of(self, i: Union[Fact, Token]) -> Fact:
+        if isinstance(i, Fact):
+            return Value('_db', 'as_of', i.value)
+        return Value('_db', 'as_of_time', i.value.replace('T', ' '))
+
     @v_args(inline=True)  # type: ignore
     def simpletext(self, i: Token) -> Fact:
         return Content(i.value.strip())
 
+    @v_args(inline=True)  # type: ignore
+    def searchtext(self, i: Token) -> Fact:
+        return Content(i.value.strip())
+
     @v_args(inline=True)  # type: ignore
     def quotedtext(self, i: Token) -> Fact:
         match = i.value
@@ -38,3 +84,78 @@ class JqlTransformer(Transformer[Tree]):  # type: ignore
         if match.endswith(']]]'):
             match = match[:-3]
         return Content(match.strip())
+
+
+# Hand-written matchers for the hottest query shapes, "@ref" and lists of
+# "#tag" / "#tag/prop" terms. These must agree exactly with the grammar.
+# A query starting with a tab, \f or \r lexes as content, so only spaces
+# and newlines may lead.
+LEAD = r'[ \n]*'
+WS = r'[ \t\f\r\n]*'
+TERM = re.compile(r'#(_?[a-z][a-z0-9]*)(?:/([a-z][_a-z0-9]*))?' + WS)
+REF_QUERY = re.compile(LEAD + r'@([0-9a-f]+|\?)' + WS)
+LIST_QUERY = re.compile(LEAD + f'(?:{TERM.pattern})+')
+
+# Statement separators in scripts, and the quoted text they can't split
+SEPARATOR = re.compile(r'[;\n]')
+QUOTED = re.compile(r'(\[\[\[.*?\]\]\])', re.S)
+
+
+def parse_simple(query: str) -> Optional[Tuple[str, Tuple[Fact, ...]]]:
+    """
+    Parse the simplest queries without Lark, or return None
+    """
+    match = REF_QUERY.fullmatch(query)
+    if match:
+        return ('get', (Ref(match.group(1)),))
+
+    if LIST_QUERY.fullmatch(query):
+        terms = TERM.findall(query)
+        for tag, prop in terms:
+            check_reserved(tag, prop)
+        return ('list', tuple(Flag(tag, prop) if prop else Tag(tag) for tag, prop in terms))
+
+    return None
+
+
+def parse_lark(query: str) -> Tuple[str, Tuple[Fact, ...]]:
+    try:
+        ast = JqlTransformer().transform(jql_parser.parse(query))
+    except VisitError as e:
+        raise e.orig_exc
+    values: List[Fact] = []
+    for c in ast.children:
+        if isinstance(c, Fact):
+            values.append(c)
+        elif isinstance(c, list):
+            values.extend(c)
+    return (ast.data, tuple(values))
+
+
+def split_script(script: str) -> List[str]:
+    """
+    Split a script into statements on newlines and semicolons, except
+    inside [[[quoted text]]]. Blank statements are dropped.
+    """
+    statements: List[str] = []
+    current = ''
+    for i, part in enumerate(QUOTED.split(script)):
+        if i % 2:
+            current += part
+            continue
+        pieces = SEPARATOR.split(part)
+        current += pieces[0]
+        for piece in pieces[1:]:
+            statements.append(current)
+            current = piece
+    statements.append(current)
+    return [s.strip() for s in statements if s.strip()]
+
+
+@lru_cache(maxsize=1024)
+def parse(query: str) -> Tuple[str, Tuple[Fact, ...]]:
+    """
+    Parse and transform a query into its action and values, caching the
+    result by query text. Parse errors are raised and not cached.
+    """
+    return parse_simple(query) or parse_lark(query)
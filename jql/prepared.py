@@ -0,0 +1,66 @@
+from typing import List, Tuple, TYPE_CHECKING, Union
+
+from jql.parser import parse
+from jql.types import Fact, is_ref
+
+if TYPE_CHECKING:
+    from jql.client import Client
+    from jql.types import Item
+
+
+PLACEHOLDER = '?'
+
+# Values that hold a ref, and so take a ref when bound
+REF_VALUES = {('_db', 'after'), ('_db', 'as_of')}
+
+
+def is_placeholder(fact: Fact) -> bool:
+    return fact.value == PLACEHOLDER
+
+
+def is_unbound_ref(fact: Fact) -> bool:
+    return is_placeholder(fact) and (is_ref(fact) or (fact.tag, fact.prop) in REF_VALUES)
+
+
+class PreparedQuery:
+    """
+    A query parsed once, with `?` placeholders for refs (`@?`, `AFTER @?`,
+    `AS OF @?`), values (`#todo/due=?`) and content (`CREATE ? #todo`).
+
+    Bound values are substituted straight into the parsed values, so they
+    are never parsed as JQL themselves.
+    """
+    def __init__(self, client: 'Client', query: str) -> None:
+        self._client = client
+        self.query = query
+        self._action, self._values = parse(query)
+        self._placeholders = [i for i, v in enumerate(self._values) if is_placeholder(v)]
+
+    def __repr__(self) -> str:
+        return f"PreparedQuery({self.query})"
+
+    @property
+    def placeholders(self) -> int:
+        return len(self._placeholders)
+
+    def bind(self, *params: Union[str, Fact]) -> Tuple[str, List[Fact]]:
+        if len(params) != len(self._placeholders):
+            raise Exception(f'Query expects {len(self._placeholders)} values, {len(params)} supplied')
+
+        values = list(self._values)
+        for i, param in zip(self._placeholders, params):
+            fact = values[i]
+            if isinstance(param, Fact):
+                if not is_ref(param):
+                    raise Exception(f'Only refs can be bound as facts, not {param}')
+                param = param.value
+            elif is_unbound_ref(fact):
+                param = param.lstrip('@')
+            if not param:
+                raise Exception('Empty value supplied')
+            values[i] = Fact(fact.tag, fact.prop, param)
+        return (self._action, values)
+
+    def execute(self, *params: Union[str, Fact]) -> List['Item']:
+        tree = self.bind(*params)
+        return self._client.new_transaction().q(self.query, tree=tree)
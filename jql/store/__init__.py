@@ -1,25 +1,74 @@
 from abc import ABC, abstractmethod
-from hashids import Hashids  # type: ignore
-from huey.contrib.mini import MiniHuey  # type: ignore
+from collections import OrderedDict
 import datetime
+from functools import cached_property
+from itertools import islice
 import json
-import string
 import os
-from typing import List, Optional, Iterable, Set, Tuple
+import threading
+import time
+from typing import ContextManager, Iterator, List, NamedTuple, Optional, Iterable, Set, Tuple, TYPE_CHECKING
 import uuid
 
 
-from jql.types import Content, Fact, get_content, get_created_time, has_flag, Item, is_ref, Ref, Tag, Value
+from jql.types import Content, Fact, get_content, get_created_time, get_ref, has_flag, Item, is_ref, Tag, Value
 from jql.changeset import ChangeSet
-from jql.tasks import Replicator
+from jql.store.refcodec import get_codec
+
+if TYPE_CHECKING:
+    from huey.contrib.mini import MiniHuey  # type: ignore
+    from jql.tasks import Replicator
+
+
+class ItemCacheInfo(NamedTuple):
+    hits: int
+    misses: int
+    maxsize: int
+    currsize: int
+
+
+class PendingCommit:
+    """
+    A changeset waiting to be committed as part of a group
+    """
+    def __init__(self, changeset: ChangeSet) -> None:
+        self.changeset = changeset
+        self.done = threading.Event()
+        self.result: List[Item] = []
+        self.error: Optional[BaseException] = None
 
 
 class Store(ABC):
-    def __init__(self, salt: str = "") -> None:
+    def __init__(self, salt: str = "", item_cache_size: int = 0, group_commit_window: float = 0) -> None:
         self._salt = salt if salt else str(uuid.uuid4())
-        self.taskqueue = MiniHuey()
-        self.taskqueue.start()
-        self.replicator = Replicator(self)
+        self._codec = get_codec(self._salt)
+
+        # Optional LRU cache of current items by ref, off when size is 0
+        self._item_cache: OrderedDict[str, Item] = OrderedDict()
+        self._item_cache_size = item_cache_size
+        self._item_cache_lock = threading.Lock()
+        self._item_cache_generation = 0
+        self._item_cache_hits = 0
+        self._item_cache_misses = 0
+
+        # Group commit, off when the window is 0
+        self._group_commit_window = group_commit_window
+        self._group_commit_lock = threading.Lock()
+        self._group_commit_queue: List[PendingCommit] = []
+        self._group_commit_leader = False
+
+    @cached_property
+    def taskqueue(self) -> 'MiniHuey':
+        # huey, and pynamodb below, are only imported once replication is used
+        from huey.contrib.mini import MiniHuey
+        taskqueue = MiniHuey()
+        taskqueue.start()
+        return taskqueue
+
+    @cached_property
+    def replicator(self) -> 'Replicator':
+        from jql.tasks import Replicator
+        return Replicator(self)
 
     @property
     def replicate(self) -> bool:
@@ -36,13 +85,98 @@ class Store(ABC):
     def get_last_ingested_changeset(self, dbuuid: str) -> int:
         return self._get_last_ingested_changeset(dbuuid)
 
-    def get_item(self, ref: Fact) -> Optional[Item]:
+    def get_item(self, ref: Fact, as_of: Optional[Fact] = None) -> Optional[Item]:
+        """
+        Fetch an item, or with as_of (a transaction ref) the item as it was
+        once that transaction had been applied
+        """
         if not is_ref(ref):
             raise Exception("No ref supplied for get_item")
-        return self._get_item(ref)
-
-    def get_items(self, search: Iterable[Fact]) -> List[Item]:
-        return self._get_items(search)
+        if as_of is not None and not is_ref(as_of):
+            raise Exception("as_of for get_item must be a transaction ref")
+        if as_of is None and self._item_cache_size > 0:
+            return self._get_cached_item(ref)
+        return self._get_item(ref, as_of=as_of)
+
+    def item_cache_info(self) -> ItemCacheInfo:
+        with self._item_cache_lock:
+            return ItemCacheInfo(self._item_cache_hits, self._item_cache_misses, self._item_cache_size, len(self._item_cache))
+
+    def _get_cached_item(self, ref: Fact) -> Optional[Item]:
+        with self._item_cache_lock:
+            item = self._item_cache.get(ref.value)
+            if item is not None:
+                self._item_cache.move_to_end(ref.value)
+                self._item_cache_hits += 1
+                return item
+            self._item_cache_misses += 1
+            generation = self._item_cache_generation
+
+        item = self._get_item(ref)
+        if item is None:
+            return None
+
+        with self._item_cache_lock:
+            # Don't cache a read that raced with a write, it may be stale
+            if generation == self._item_cache_generation:
+                self._item_cache[ref.value] = item
+                if len(self._item_cache) > self._item_cache_size:
+                    self._item_cache.popitem(last=False)
+        return item
+
+    def _invalidate_cached_items(self, changesets: Iterable[ChangeSet]) -> None:
+        if self._item_cache_size <= 0:
+            return
+        # Newly created items can't be cached yet, so only look up the rest
+        uuids = {
+            change.uuid
+            for changeset in changesets
+            for change in changeset.changes
+            if change.revoke or not has_flag(iter(change.facts), '_db', 'created')
+        }
+        refs = [self._uuid_to_ref(uid) for uid in uuids]
+        with self._item_cache_lock:
+            self._item_cache_generation += 1
+            for ref in refs:
+                if ref is not None:
+                    self._item_cache.pop(ref.value, None)
+
+    def get_items(self, search: Iterable[Fact], limit: Optional[int] = None, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> List[Item]:
+        if after is not None and not is_ref(after):
+            raise Exception("Cursor for get_items must be a ref")
+        if as_of is not None and not is_ref(as_of):
+            raise Exception("as_of for get_items must be a transaction ref")
+        return self._get_items(search, limit=limit, after=after, as_of=as_of)
+
+    def get_matching_uuids(self, search: Iterable[Fact]) -> List[str]:
+        """
+        uuids of every live item matching all the search terms, oldest first
+        """
+        search = list(search)
+        if not search:
+            raise Exception("No search criteria supplied")
+        return self._get_matching_uuids(search)
+
+    def get_tx_ref_as_of(self, timestamp: str) -> Optional[Fact]:
+        """
+        Ref of the last transaction created at or before timestamp
+        """
+        return self._get_tx_ref_as_of(timestamp)
+
+    def iter_items(self, search: Iterable[Fact], page_size: int = 100, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> Iterator[Item]:
+        """
+        Stream every matching item, fetching page_size items at a time.
+
+        Pages are keyed on the last item seen (ordered by created time and
+        then id), so items created while iterating don't shift the results.
+        """
+        search = list(search)
+        while True:
+            page = self.get_items(search, limit=page_size, after=after, as_of=as_of)
+            yield from page
+            if len(page) < page_size:
+                return
+            after = get_ref(page[-1])
 
     def get_hints(self, search: str = "") -> List[Item]:
         search_terms = search.lstrip('#').split('/', 1)
@@ -66,7 +200,81 @@ class Store(ABC):
             raise Exception(f"Attempt to record a changeset that already exists! {changeset.uuid}, origin: {changeset.origin}")
         return self._record_changeset(changeset)
 
+    def commit_changeset(self, changeset: ChangeSet) -> List[Item]:
+        """
+        Record and apply a changeset.
+
+        With a group commit window, changesets committed from other threads
+        within the window are recorded and applied together in a single
+        store transaction. Each changeset still gets its own savepoint, so a
+        failing changeset is rolled back (and not recorded) without
+        affecting the rest of its group.
+        """
+        if self._group_commit_window <= 0:
+            cid = self.record_changeset(changeset)
+            return self.apply_changeset(cid)
+
+        pending = PendingCommit(changeset)
+        with self._group_commit_lock:
+            self._group_commit_queue.append(pending)
+            leader = not self._group_commit_leader
+            self._group_commit_leader = True
+
+        if leader:
+            # Give other writers the window to join this group
+            time.sleep(self._group_commit_window)
+            with self._group_commit_lock:
+                group = self._group_commit_queue
+                self._group_commit_queue = []
+                self._group_commit_leader = False
+            self._commit_group(group)
+
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _commit_group(self, group: List[PendingCommit]) -> None:
+        committed: List[ChangeSet] = []
+        try:
+            with self._transaction():
+                for i, pending in enumerate(group):
+                    try:
+                        with self._savepoint(f'commit_{i}'):
+                            cid = self.record_changeset(pending.changeset)
+                            pending.result = self._apply_changeset(cid)
+                        committed.append(pending.changeset)
+                    except Exception as e:
+                        pending.error = e
+        except BaseException as e:
+            # The group transaction itself failed, so nothing was committed
+            committed = []
+            for pending in group:
+                pending.error = pending.error or e
+                pending.result = []
+            raise
+        finally:
+            try:
+                if committed:
+                    self._invalidate_cached_items(committed)
+                    self.replicate_changesets()
+            finally:
+                for pending in group:
+                    pending.done.set()
+
     def apply_changeset(self, changeset_uuid: str) -> List[Item]:
+        # The whole changeset is applied in a single transaction, and rolled
+        # back if any part of it fails
+        with self._transaction():
+            resp = self._apply_changeset(changeset_uuid)
+        if self._item_cache_size > 0:
+            self._invalidate_cached_items([self._load_changeset(changeset_uuid)])
+
+        # Trigger replication
+        self.replicate_changesets()
+        return resp
+
+    def _apply_changeset(self, changeset_uuid: str, applied_at: Optional[str] = None) -> List[Item]:
         changeset = self._load_changeset(changeset_uuid)
 
         # Make sure we aren't reapplying a changeset
@@ -75,11 +283,91 @@ class Store(ABC):
 
         # Commit changeset
         cs_ref, _ = self._next_ref(changeset.uuid, created=str(changeset.created), changeset=True)
-        content = json.dumps(changeset.changes_as_dict())
+        cs = Item(facts=self._changeset_facts(cs_ref, changeset, json.dumps(changeset.changes_as_dict()), created=applied_at))
+        self._create_item(cs_ref, str(changeset.uuid), cs)
+
+        resp = self._apply_changes(cs_ref, changeset)
+
+        # Update applied value for changeset
+        self._update_changeset(changeset, applied=True)
+        return resp
+
+    def _apply_changes(self, cs_ref: Fact, changeset: ChangeSet) -> List[Item]:
+        resp: List[Item] = []
+        for i, change in enumerate(changeset.changes):
+            # if changeset.origin != self.uuid:
+            # We'll need to translate refs
+            # pass
+            with self._savepoint(f'change_{i}'):
+                if change.revoke:
+                    resp.append(self._revoke_item_facts(cs_ref, change.uuid, change.facts))
+                else:
+                    # If creating
+                    if has_flag(iter(change.facts), '_db', 'created'):
+                        created = get_created_time(iter(change.facts))
 
+                        new_ref, _ = self._next_ref(change.uuid, created=created.value)
+                        new_item = Item(facts=frozenset(change.facts.union({new_ref})))
+                        resp.append(self._create_item(cs_ref, change.uuid, new_item))
+                    # If updating
+                    else:
+                        resp.append(self._update_item(cs_ref, change.uuid, change.facts))
+
+        return resp
+
+    def apply_changesets_bulk(self, changesets: Iterable[ChangeSet], batch_size: int = 500) -> Tuple[int, int]:
+        """
+        Record and apply changesets in batches, one transaction per batch.
+
+        Changesets that have already been recorded are skipped, so a log can
+        be replayed again after an interruption. Returns the number of
+        changesets and changes applied rather than the updated items.
+        """
+        applied_changesets = 0
+        applied_changes = 0
+
+        seen: Set[str] = set()
+        changesets = iter(changesets)
+        while True:
+            batch = list(islice(changesets, batch_size))
+            if not batch:
+                break
+
+            existing = self._get_existing_changesets([cs.uuid for cs in batch])
+            new = []
+            for cs in batch:
+                if cs.uuid in existing or cs.uuid in seen:
+                    continue
+                seen.add(cs.uuid)
+                new.append(cs)
+
+            if not new:
+                continue
+
+            with self._transaction():
+                applied_changes += self._apply_changesets_bulk(new)
+            self._invalidate_cached_items(new)
+            applied_changesets += len(new)
+
+        # Trigger replication
+        self.replicate_changesets()
+        return (applied_changesets, applied_changes)
+
+    def compact(self, horizon: datetime.datetime) -> int:
+        """
+        Move superseded and revoked facts written by transactions created
+        before horizon out of the hot facts table and into the fact history.
+        HISTORY and AS OF reads still see them. Returns the number of facts
+        moved.
+        """
+        with self._transaction():
+            return self._compact(str(horizon))
+
+    def _changeset_facts(self, cs_ref: Fact, changeset: ChangeSet, content: str, created: Optional[str] = None) -> Set[Fact]:
+        # created is when the changeset was applied, now unless given
         facts = {
             cs_ref,
-            Value('_db', 'created', str(datetime.datetime.now())),
+            Value('_db', 'created', created or str(datetime.datetime.now())),
             Tag('_tx'),
             Value('_tx', 'client', changeset.client),
             Value('_tx', 'created', str(changeset.created)),
@@ -91,34 +379,7 @@ class Store(ABC):
         if changeset.query:
             facts.add(Value('_tx', 'query', changeset.query))
 
-        cs = Item(facts=facts)
-        self._create_item(cs_ref, str(changeset.uuid), cs)
-
-        resp: List[Item] = []
-        for change in changeset.changes:
-            # if changeset.origin != self.uuid:
-            # We'll need to translate refs
-            # pass
-            if change.revoke:
-                resp.append(self._revoke_item_facts(cs_ref, change.uuid, change.facts))
-            else:
-                # If creating
-                if has_flag(iter(change.facts), '_db', 'created'):
-                    created = get_created_time(iter(change.facts))
-
-                    new_ref, _ = self._next_ref(change.uuid, created=created.value)
-                    new_item = Item(facts=frozenset(change.facts.union({new_ref})))
-                    resp.append(self._create_item(cs_ref, change.uuid, new_item))
-                # If updating
-                else:
-                    resp.append(self._update_item(cs_ref, change.uuid, change.facts))
-
-        # Update applied value for changeset
-        self._update_changeset(changeset, applied=True)
-
-        # Trigger replication
-        self.replicate_changesets()
-        return resp
+        return facts
 
     def replicate_changesets(self) -> None:
         if not self.replicate:
@@ -153,17 +414,25 @@ class Store(ABC):
 
     @classmethod
     def ref_to_id(cls, uuid: str, ref: Fact) -> int:
-        return int(Hashids(salt=uuid, alphabet=string.hexdigits[:16], min_length=6).decode(ref.value)[0])
+        return get_codec(uuid).decode(ref)
 
     @classmethod
     def id_to_ref(cls, uuid: str, i: int) -> Fact:
-        return Ref(Hashids(salt=uuid, alphabet=string.hexdigits[:16], min_length=6).encode(i))
+        return get_codec(uuid).encode(i)
 
     def _ref_to_id(self, ref: Fact) -> int:
-        return self.ref_to_id(self.uuid, ref)
+        return self._codec.decode(ref)
 
     def _id_to_ref(self, i: int) -> Fact:
-        return self.id_to_ref(self.uuid, i)
+        return self._codec.encode(i)
+
+    @abstractmethod
+    def _transaction(self) -> ContextManager[None]:
+        pass
+
+    @abstractmethod
+    def _savepoint(self, name: str) -> ContextManager[None]:
+        pass
 
     @abstractmethod
     def _get_tags_as_items(self, prefix: str = '') -> List[Item]:
@@ -174,7 +443,11 @@ class Store(ABC):
         pass
 
     @abstractmethod
-    def _get_item(self, ref: Fact) -> Optional[Item]:
+    def _get_item(self, ref: Fact, as_of: Optional[Fact] = None) -> Optional[Item]:
+        pass
+
+    @abstractmethod
+    def _get_tx_ref_as_of(self, timestamp: str) -> Optional[Fact]:
         pass
 
     @abstractmethod
@@ -190,7 +463,11 @@ class Store(ABC):
         pass
 
     @abstractmethod
-    def _get_items(self, search: Iterable[Fact]) -> List[Item]:
+    def _get_matching_uuids(self, search: List[Fact]) -> List[str]:
+        pass
+
+    @abstractmethod
+    def _get_items(self, search: Iterable[Fact], limit: Optional[int] = None, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> List[Item]:
         pass
 
     @abstractmethod
@@ -217,6 +494,14 @@ class Store(ABC):
     def _load_changeset(self, changeset_uuid: str) -> ChangeSet:
         pass
 
+    @abstractmethod
+    def _get_existing_changesets(self, changeset_uuids: List[str]) -> Set[str]:
+        pass
+
+    @abstractmethod
+    def _apply_changesets_bulk(self, changesets: List[ChangeSet]) -> int:
+        pass
+
     @abstractmethod
     def _get_changesets_as_items(self) -> List[Item]:
         pass
@@ -225,6 +510,10 @@ class Store(ABC):
     def _get_unreplicated_changesets(self) -> List[ChangeSet]:
         pass
 
+    @abstractmethod
+    def _compact(self, horizon: str) -> int:
+        pass
+
     @abstractmethod
     def _get_history(self, ref: Optional[Fact] = None) -> List[Item]:
         pass
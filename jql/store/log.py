@@ -0,0 +1,246 @@
+from contextlib import contextmanager
+import datetime
+import json
+import mmap
+import os
+import pickle  # noqa: S403
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+
+from jql.changeset import ChangeSet
+from jql.types import Item
+from jql.store.memory import MemoryStore
+
+
+# MemoryStore attributes that make up the item index, saved by checkpoints
+STATE = (
+    '_ids', '_by_ref', '_by_uuid', '_log', '_log_keys', '_live',
+    '_by_tag', '_by_prop', '_by_value', '_content', '_changesets',
+)
+
+
+class LogStore(MemoryStore):
+    """
+    Store that keeps its data as an append-only log of changeset records in
+    segment files under a directory, with the index of current facts held in
+    memory (see MemoryStore).
+
+    Each committed transaction is appended as a single JSON line to the
+    current segment, so writes are purely sequential. On open the index is
+    loaded from the last checkpoint and the segments written since then are
+    replayed through mmap. A transaction torn by a crash is dropped from the
+    end of the log.
+    """
+    def __init__(self, location: str, salt: str = "", segment_size: int = 64 * 1024 * 1024, checkpoint_interval: int = 10000, fsync: bool = False, item_cache_size: int = 0, group_commit_window: float = 0) -> None:
+        self._location = location
+        self._segment_size = segment_size
+        self._checkpoint_interval = checkpoint_interval
+        self._fsync = fsync
+        self._pending: List[Dict[str, Any]] = []
+        self._replaying = False
+        self._applied_at: Optional[str] = None
+        self._since_checkpoint = 0
+        self._segment: Optional[BinaryIO] = None
+        self._segment_no = 1
+
+        os.makedirs(location, exist_ok=True)
+        meta_path = os.path.join(location, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                salt = json.load(f)['salt']
+            super().__init__(salt, item_cache_size=item_cache_size, group_commit_window=group_commit_window)
+        else:
+            super().__init__(salt, item_cache_size=item_cache_size, group_commit_window=group_commit_window)
+            self._write_atomic(meta_path, json.dumps({'salt': self._salt}).encode())
+
+        self._load()
+
+    # Segments
+
+    def _segment_path(self, segment_no: int) -> str:
+        return os.path.join(self._location, f'segment-{segment_no:08d}.log')
+
+    def _segment_numbers(self) -> List[int]:
+        return sorted(
+            int(name[8:-4])
+            for name in os.listdir(self._location)
+            if name.startswith('segment-') and name.endswith('.log')
+        )
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        tmp = f'{path}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _load(self) -> None:
+        segment_no, offset = 1, 0
+        checkpoint_path = os.path.join(self._location, 'checkpoint.pickle')
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'rb') as f:
+                # Only ever written by checkpoint() below
+                checkpoint = pickle.load(f)  # noqa: S301
+            for name in STATE:
+                setattr(self, name, checkpoint['state'][name])
+            segment_no, offset = checkpoint['segment'], checkpoint['offset']
+
+        self._segment_no = segment_no
+        self._replaying = True
+        try:
+            for number in self._segment_numbers():
+                if number < segment_no:
+                    continue
+                self._segment_no = number
+                self._replay_segment(number, offset if number == segment_no else 0)
+        finally:
+            self._replaying = False
+
+        self._segment = open(self._segment_path(self._segment_no), 'ab')
+
+    def _replay_segment(self, segment_no: int, offset: int) -> None:
+        path = self._segment_path(segment_no)
+        size = os.path.getsize(path)
+        if size <= offset:
+            return
+
+        good = offset
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.seek(offset)
+            while mm.tell() < size:
+                line = mm.readline()
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    records = json.loads(line)
+                except ValueError:
+                    break
+                self._replay(records)
+                good = mm.tell()
+                self._since_checkpoint += 1
+
+        if good < size:
+            # Drop the torn tail so new writes follow the last good record
+            with open(path, 'r+b') as segment:
+                segment.truncate(good)
+
+    def _replay(self, records: List[Dict[str, Any]]) -> None:
+        with self._transaction():
+            for record in records:
+                if record['op'] == 'record':
+                    self._record_changeset(ChangeSet.from_dict(record['changeset']))
+                elif record['op'] == 'update':
+                    changeset = self._load_changeset(record['uuid'])
+                    if record.get('applied') and not changeset.applied:
+                        self._apply_changeset(record['uuid'], applied_at=record.get('applied_at'))
+                    if record.get('replicated') is not None:
+                        self._update_changeset(changeset, replicated=record['replicated'])
+                else:
+                    raise Exception(f"Unknown log record {record['op']}")
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        if not self._replaying:
+            self._pending.append(record)
+
+    def _flush(self) -> None:
+        if not self._pending or self._segment is None:
+            self._pending = []
+            return
+
+        line = json.dumps(self._pending, separators=(',', ':')).encode() + b'\n'
+        self._pending = []
+        self._segment.write(line)
+        self._segment.flush()
+        if self._fsync:
+            os.fsync(self._segment.fileno())
+        self._since_checkpoint += 1
+
+        if self._segment.tell() >= self._segment_size:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        if self._segment is not None:
+            self._segment.close()
+        self._segment_no += 1
+        self._segment = open(self._segment_path(self._segment_no), 'ab')
+
+    def _position(self) -> Tuple[int, int]:
+        assert self._segment is not None
+        return (self._segment_no, self._segment.tell())
+
+    def checkpoint(self) -> None:
+        """
+        Save the in-memory index, so the next open only replays the log
+        written after this point
+        """
+        with self._lock:
+            if self._tx_depth:
+                raise Exception('Cannot checkpoint inside a transaction')
+            segment_no, offset = self._position()
+            data = pickle.dumps({
+                'segment': segment_no,
+                'offset': offset,
+                'state': {name: getattr(self, name) for name in STATE},
+            }, protocol=pickle.HIGHEST_PROTOCOL)
+            self._write_atomic(os.path.join(self._location, 'checkpoint.pickle'), data)
+            self._since_checkpoint = 0
+
+    def close(self) -> None:
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        with super()._transaction():
+            outer = self._tx_depth == 1
+            try:
+                yield
+                # Write before leaving, so a failed write still rolls back
+                if outer:
+                    self._flush()
+            except BaseException:
+                if outer:
+                    self._pending = []
+                raise
+
+        if outer and not self._replaying and self._checkpoint_interval and self._since_checkpoint >= self._checkpoint_interval:
+            self.checkpoint()
+
+    @contextmanager
+    def _savepoint(self, name: str) -> Iterator[None]:
+        with super()._savepoint(name):
+            mark = len(self._pending)
+            try:
+                yield
+            except BaseException:
+                # Records made since the savepoint are rolled back with it
+                del self._pending[mark:]
+                raise
+
+    # Changesets
+
+    def _record_changeset(self, changeset: ChangeSet) -> str:
+        with self._transaction():
+            uuid = super()._record_changeset(changeset)
+            self._append({'op': 'record', 'changeset': self._changesets[uuid].changeset.to_dict()})
+        return uuid
+
+    def _apply_changeset(self, changeset_uuid: str, applied_at: Optional[str] = None) -> List[Item]:
+        # Fix the _tx item's created time up front, so it can be logged with
+        # the applied flag and replayed exactly
+        self._applied_at = applied_at or str(datetime.datetime.now())
+        try:
+            return super()._apply_changeset(changeset_uuid, applied_at=self._applied_at)
+        finally:
+            self._applied_at = None
+
+    def _update_changeset(self, changeset: ChangeSet, replicated: Optional[bool] = None, applied: Optional[bool] = None) -> None:
+        with self._transaction():
+            super()._update_changeset(changeset, replicated=replicated, applied=applied)
+            record: Dict[str, Any] = {'op': 'update', 'uuid': changeset.uuid, 'replicated': replicated, 'applied': applied}
+            if applied and self._applied_at is not None:
+                record['applied_at'] = self._applied_at
+            self._append(record)
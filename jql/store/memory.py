@@ -0,0 +1,562 @@
+from bisect import bisect_right
+from contextlib import contextmanager
+from dataclasses import dataclass
+import threading
+from typing import Callable, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+
+
+from jql.changeset import ChangeSet, decode_changes, encode_changes
+from jql.store import Store
+from jql.types import Content, Fact, Flag, Item, Ref, Tag, Value, has_value, is_content, is_flag, is_tag
+
+
+Key = Tuple[str, str]
+
+
+@dataclass()
+class IdEntry:
+    dbid: int
+    ref: str
+    uuid: Optional[str]
+    changeset_uuid: Optional[str]
+    created: str
+    archived: bool = False
+
+    @property
+    def is_tx(self) -> bool:
+        return self.changeset_uuid is not None
+
+
+@dataclass()
+class LogEntry:
+    changeset: int
+    dbid: int
+    tag: str
+    prop: str
+    val: str
+    revoke: bool
+
+
+@dataclass()
+class ChangeSetEntry:
+    rowid: int
+    changeset: ChangeSet
+
+
+class MemoryStore(Store):
+    """
+    Store kept entirely in Python data structures, for ephemeral stores and
+    tests.
+
+    The current facts of every item are indexed by tag, tag/prop and
+    tag/prop/value (only for items that are live, not archived and not
+    transactions), alongside the full fact log for history and AS OF reads.
+    Every mutation records how to undo itself while a transaction is open, so
+    failed changesets and savepoints roll back just like SqliteStore.
+    """
+    def __init__(self, salt: str = "", item_cache_size: int = 0, group_commit_window: float = 0) -> None:
+        self._lock = threading.RLock()
+        self._tx_depth = 0
+        self._undo: List[Callable[[], None]] = []
+
+        self._ids: List[IdEntry] = []
+        self._by_ref: Dict[str, int] = {}
+        self._by_uuid: Dict[str, int] = {}
+
+        # Fact log, and the log positions for each dbid/tag/prop in order
+        self._log: List[LogEntry] = []
+        self._log_keys: Dict[int, Dict[Key, List[int]]] = {}
+
+        # Current facts by dbid, as (value, tx ref)
+        self._live: Dict[int, Dict[Key, Tuple[str, str]]] = {}
+
+        # Indexes over the current facts of visible items
+        self._by_tag: Dict[str, Set[int]] = {}
+        self._by_prop: Dict[Key, Set[int]] = {}
+        self._by_value: Dict[Tuple[str, str, str], Set[int]] = {}
+        self._content: Dict[int, str] = {}
+
+        self._changesets: Dict[str, ChangeSetEntry] = {}
+
+        super().__init__(salt, item_cache_size=item_cache_size, group_commit_window=group_commit_window)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # Nested calls join the outermost transaction
+        with self._lock:
+            if self._tx_depth:
+                self._tx_depth += 1
+                try:
+                    yield
+                finally:
+                    self._tx_depth -= 1
+                return
+
+            self._tx_depth = 1
+            try:
+                yield
+            except BaseException:
+                self._rollback(0)
+                raise
+            finally:
+                self._tx_depth = 0
+                self._undo = []
+
+    @contextmanager
+    def _savepoint(self, name: str) -> Iterator[None]:
+        with self._transaction():
+            mark = len(self._undo)
+            try:
+                yield
+            except BaseException:
+                self._rollback(mark)
+                raise
+
+    def _rollback(self, mark: int) -> None:
+        while len(self._undo) > mark:
+            self._undo.pop()()
+
+    def _journal(self, undo: Callable[[], None]) -> None:
+        if self._tx_depth:
+            self._undo.append(undo)
+
+    # Mutation primitives. Each one journals its own inverse.
+
+    def _add_id(self, entry: IdEntry) -> None:
+        self._ids.append(entry)
+        self._by_ref[entry.ref] = entry.dbid
+        self._by_uuid[entry.uuid or str(entry.changeset_uuid)] = entry.dbid
+        self._live[entry.dbid] = {}
+        self._log_keys[entry.dbid] = {}
+
+        def undo() -> None:
+            self._ids.pop()
+            del self._by_ref[entry.ref]
+            del self._by_uuid[entry.uuid or str(entry.changeset_uuid)]
+            del self._live[entry.dbid]
+            del self._log_keys[entry.dbid]
+        self._journal(undo)
+
+    def _append_log(self, entry: LogEntry) -> None:
+        pos = len(self._log)
+        self._log.append(entry)
+        positions = self._log_keys[entry.dbid].setdefault((entry.tag, entry.prop), [])
+        positions.append(pos)
+
+        def undo() -> None:
+            self._log.pop()
+            positions.pop()
+            if not positions:
+                del self._log_keys[entry.dbid][(entry.tag, entry.prop)]
+        self._journal(undo)
+
+    def _set_live(self, dbid: int, key: Key, value: Optional[Tuple[str, str]]) -> None:
+        facts = self._live[dbid]
+        old = facts.get(key)
+        if old == value:
+            return
+        self._set_live_raw(dbid, key, value)
+        self._journal(lambda: self._set_live_raw(dbid, key, old))
+
+    def _set_live_raw(self, dbid: int, key: Key, value: Optional[Tuple[str, str]]) -> None:
+        facts = self._live[dbid]
+        visible = self._visible(dbid)
+        if key in facts and visible:
+            self._unindex(dbid, key, facts.pop(key)[0])
+        if value is None:
+            facts.pop(key, None)
+        else:
+            facts[key] = value
+            if visible:
+                self._index(dbid, key, value[0])
+
+    def _set_archived(self, dbid: int, archived: bool) -> None:
+        old = self._ids[dbid - 1].archived
+        if old == archived:
+            return
+        self._set_archived_raw(dbid, archived)
+        self._journal(lambda: self._set_archived_raw(dbid, old))
+
+    def _set_archived_raw(self, dbid: int, archived: bool) -> None:
+        entry = self._ids[dbid - 1]
+        if self._visible(dbid):
+            facts = self._live[dbid]
+            self._live[dbid] = {}
+            for key, (val, _) in facts.items():
+                self._unindex(dbid, key, val)
+            self._live[dbid] = facts
+        entry.archived = archived
+        if self._visible(dbid):
+            for key, (val, _) in self._live[dbid].items():
+                self._index(dbid, key, val)
+
+    def _put_changeset(self, changeset: ChangeSet) -> None:
+        self._changesets[changeset.uuid] = ChangeSetEntry(rowid=len(self._changesets) + 1, changeset=changeset)
+
+        def undo() -> None:
+            del self._changesets[changeset.uuid]
+        self._journal(undo)
+
+    def _set_changeset_flag(self, changeset_uuid: str, flag: str, value: bool) -> None:
+        stored = self._changesets[changeset_uuid].changeset
+        old = getattr(stored, flag)
+        setattr(stored, flag, value)
+        self._journal(lambda: setattr(stored, flag, old))
+
+    # Indexes
+
+    def _visible(self, dbid: int) -> bool:
+        entry = self._ids[dbid - 1]
+        return not entry.archived and not entry.is_tx
+
+    def _index(self, dbid: int, key: Key, val: str) -> None:
+        tag, prop = key
+        self._by_tag.setdefault(tag, set()).add(dbid)
+        self._by_prop.setdefault(key, set()).add(dbid)
+        self._by_value.setdefault((tag, prop, val), set()).add(dbid)
+        if key == ('_db', 'content'):
+            self._content[dbid] = val.lower()
+
+    def _unindex(self, dbid: int, key: Key, val: str) -> None:
+        # Called once the fact has been taken out of self._live
+        tag, prop = key
+        self._discard(self._by_prop, key, dbid)
+        self._discard(self._by_value, (tag, prop, val), dbid)
+        if not any(t == tag for t, _ in self._live[dbid]):
+            self._discard(self._by_tag, tag, dbid)
+        if key == ('_db', 'content'):
+            del self._content[dbid]
+
+    def _discard(self, index: Dict, key: object, dbid: int) -> None:  # type: ignore
+        dbids = index.get(key)
+        if dbids is None:
+            return
+        dbids.discard(dbid)
+        if not dbids:
+            del index[key]
+
+    # Refs and ids
+
+    def _next_ref(self, uid: str, created: str, changeset: bool = False) -> Tuple[Fact, int]:
+        with self._transaction():
+            itemid = len(self._ids) + 1
+            new_ref = self._id_to_ref(itemid)
+            if new_ref.value in self._by_ref:
+                raise Exception(f"{new_ref} item should not already exist")
+            self._add_id(IdEntry(
+                dbid=itemid,
+                ref=new_ref.value,
+                uuid=None if changeset else uid,
+                changeset_uuid=uid if changeset else None,
+                created=created,
+            ))
+        return (new_ref, itemid)
+
+    def _uuid_to_ref(self, uuid: str) -> Optional[Fact]:
+        dbid = self._by_uuid.get(uuid)
+        if dbid is None or self._ids[dbid - 1].is_tx:
+            return None
+        return Ref(self._ids[dbid - 1].ref)
+
+    def _ref_to_uuid(self, ref: Fact) -> Optional[str]:
+        dbid = self._by_ref.get(ref.value)
+        return self._ids[dbid - 1].uuid if dbid is not None else None
+
+    def _tx_id(self, ref: Fact) -> int:
+        dbid = self._by_ref.get(ref.value)
+        if dbid is None or not self._ids[dbid - 1].is_tx:
+            raise Exception(f'{ref} is not a transaction')
+        return dbid
+
+    def _get_tx_ref_as_of(self, timestamp: str) -> Optional[Fact]:
+        with self._lock:
+            for entry in reversed(self._ids):
+                if entry.is_tx and entry.created <= timestamp:
+                    return Ref(entry.ref)
+            return None
+
+    # Reads
+
+    def _item_facts(self, dbid: int, as_of: Optional[int] = None) -> Set[Fact]:
+        if as_of is None:
+            return {Fact(tag, prop, val, tx=tx) for (tag, prop), (val, tx) in self._live[dbid].items()}
+
+        facts = set()
+        for positions in self._log_keys[dbid].values():
+            # Log positions are in changeset order, so take the last at or before as_of
+            for pos in reversed(positions):
+                entry = self._log[pos]
+                if entry.changeset <= as_of:
+                    if not entry.revoke:
+                        facts.add(Fact(entry.tag, entry.prop, entry.val, tx=self._ids[entry.changeset - 1].ref))
+                    break
+        return facts
+
+    def _get_item(self, ref: Fact, as_of: Optional[Fact] = None) -> Optional[Item]:
+        with self._lock:
+            dbid = self._by_ref.get(ref.value)
+            if dbid is None:
+                return None
+            facts = self._item_facts(dbid, self._tx_id(as_of) if as_of is not None else None)
+            if len(facts) == 0:
+                return None
+            return Item(facts=facts)
+
+    def _get_item_by_uuid(self, uuid: str) -> Optional[Item]:
+        ref = self._uuid_to_ref(uuid)
+        return self._get_item(ref) if ref else None
+
+    def _get_items(self, search: Iterable[Fact], limit: Optional[int] = None, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> List[Item]:
+        with self._lock:
+            cursor = None
+            if after is not None:
+                dbid = self._by_ref.get(after.value)
+                if dbid is None:
+                    raise Exception(f'{after} does not exist')
+                cursor = (self._ids[dbid - 1].created, dbid)
+
+            as_of_id = self._tx_id(as_of) if as_of is not None else None
+            if as_of_id is not None:
+                candidates = self._as_of_matches(list(search), as_of_id)
+            else:
+                candidates = self._matches(list(search))
+
+            ordered = sorted((self._ids[dbid - 1].created, dbid) for dbid in candidates)
+            if cursor is not None:
+                ordered = ordered[bisect_right(ordered, cursor):]
+            if limit is not None:
+                ordered = ordered[:limit]
+
+            return [Item(facts=self._item_facts(dbid, as_of_id)) for _, dbid in ordered]
+
+    def _get_matching_uuids(self, search: List[Fact]) -> List[str]:
+        with self._lock:
+            uuids = []
+            for _, dbid in sorted((self._ids[dbid - 1].created, dbid) for dbid in self._matches(search)):
+                uuid = self._ids[dbid - 1].uuid
+                if uuid is not None:
+                    uuids.append(uuid)
+            return uuids
+
+    def _matches(self, search: List[Fact]) -> Set[int]:
+        matches: Optional[Set[int]] = None
+        for fact in search:
+            if is_tag(fact):
+                dbids = self._by_tag.get(fact.tag, set())
+            elif is_flag(fact):
+                dbids = self._by_prop.get((fact.tag, fact.prop), set())
+            elif is_content(fact):
+                # Content is a caseless substr match
+                term = fact.value.lower()
+                pool = matches if matches is not None else self._content.keys()
+                dbids = {dbid for dbid in pool if dbid in self._content and term in self._content[dbid]}
+            elif has_value(fact):
+                dbids = self._by_value.get((fact.tag, fact.prop, fact.value), set())
+            else:
+                raise Exception(f'Unexpected search token {fact}')
+
+            matches = set(dbids) if matches is None else matches & dbids
+            if not matches:
+                return set()
+
+        if matches is None:
+            # No search terms matches every live item
+            return {dbid for dbid in self._live if self._visible(dbid) and self._live[dbid]}
+        return matches
+
+    def _as_of_matches(self, search: List[Fact], as_of: int) -> Set[int]:
+        matches = set()
+        for entry in self._ids:
+            if entry.is_tx:
+                continue
+            facts = self._item_facts(entry.dbid, as_of)
+            if not facts or any(f.tag == '_db' and f.prop == 'archived' for f in facts):
+                continue
+            if all(self._fact_matches(fact, facts) for fact in search):
+                matches.add(entry.dbid)
+        return matches
+
+    def _fact_matches(self, search: Fact, facts: Set[Fact]) -> bool:
+        if is_tag(search):
+            return any(f.tag == search.tag for f in facts)
+        if is_flag(search):
+            return any(f.tag == search.tag and f.prop == search.prop for f in facts)
+        if is_content(search):
+            return any(is_content(f) and search.value.lower() in f.value.lower() for f in facts)
+        if has_value(search):
+            return search in facts
+        raise Exception(f'Unexpected search token {search}')
+
+    def _get_tags_as_items(self, prefix: str = '') -> List[Item]:
+        with self._lock:
+            return [
+                Item(facts={Tag(tag), Value('_db', 'count', str(len(dbids)))})
+                for tag, dbids in sorted(self._by_tag.items())
+                if tag.startswith(prefix)
+            ]
+
+    def _get_props_as_items(self, tag: str, prefix: str = '') -> List[Item]:
+        with self._lock:
+            return [
+                Item(facts={Flag(tag, prop), Value('_db', 'count', str(len(dbids)))})
+                for (t, prop), dbids in sorted(self._by_prop.items())
+                if t == tag and prop != '' and prop.startswith(prefix)
+            ]
+
+    # Writes
+
+    def _create_item(self, changeset_ref: Fact, uid: str, item: Item) -> Item:
+        self._add_facts(changeset_ref, uid, item.facts)
+        return item
+
+    def _update_item(self, changeset_ref: Fact, uid: str, new_facts: Set[Fact]) -> Item:
+        self._add_facts(changeset_ref, uid, frozenset(new_facts))
+        updated_item = self._get_item_by_uuid(uid)
+        if not updated_item:
+            raise Exception("Updated item not found")
+        return updated_item
+
+    def _revoke_item_facts(self, changeset_ref: Fact, uid: str, revoke: Set[Fact]) -> Item:
+        self._add_facts(changeset_ref, uid, frozenset(revoke), revoke=True)
+        updated_item = self._get_item_by_uuid(uid)
+        if not updated_item:
+            raise Exception("Updated item not found")
+        return updated_item
+
+    def _add_facts(self, changeset_ref: Fact, uid: str, facts: FrozenSet[Fact], revoke: bool = False) -> None:
+        with self._transaction():
+            dbid = self._by_uuid.get(uid)
+            if dbid is None:
+                raise Exception(f'Could not find item {uid} to update')
+
+            csid = self._by_ref.get(changeset_ref.value)
+            if csid is None or not self._ids[csid - 1].is_tx:
+                raise Exception('Could not find transaction')
+
+            archive_changed = None
+            for f in facts:
+                if f.tag == "_db" and f.prop == "archived":
+                    archive_changed = not revoke
+
+                self._append_log(LogEntry(changeset=csid, dbid=dbid, tag=f.tag, prop=f.prop, val=f.value, revoke=revoke))
+                self._set_live(dbid, (f.tag, f.prop), None if revoke else (f.value, changeset_ref.value))
+
+            if archive_changed is not None:
+                self._set_archived(dbid, archive_changed)
+
+    # Changesets
+
+    def _record_changeset(self, changeset: ChangeSet) -> str:
+        # Recorded changesets start out unapplied, wherever they came from
+        recorded = self._copy_changeset(changeset)
+        recorded.applied = False
+        recorded.replicated = False
+        with self._transaction():
+            self._put_changeset(recorded)
+        return changeset.uuid
+
+    def _copy_changeset(self, changeset: ChangeSet, origin_rowid: Optional[int] = None) -> ChangeSet:
+        # Changesets are copied in and out, round tripped the same way
+        # SqliteStore stores them, so callers can't change what we hold
+        return ChangeSet(
+            uuid=changeset.uuid,
+            client=changeset.client,
+            origin=changeset.origin,
+            origin_rowid=changeset.origin_rowid if origin_rowid is None else origin_rowid,
+            created=changeset.created,
+            query=changeset.query,
+            changes=decode_changes(encode_changes(changeset.changes)),
+            applied=changeset.applied,
+            replicated=changeset.replicated,
+        )
+
+    def _load_changeset(self, changeset_uuid: str) -> ChangeSet:
+        with self._lock:
+            entry = self._changesets.get(changeset_uuid)
+            if not entry:
+                raise KeyError(f'Could not find changeset {changeset_uuid}')
+            origin_rowid = entry.changeset.origin_rowid
+            if not origin_rowid and entry.changeset.origin == self.uuid:
+                origin_rowid = entry.rowid
+            return self._copy_changeset(entry.changeset, origin_rowid=origin_rowid)
+
+    def _get_existing_changesets(self, changeset_uuids: List[str]) -> Set[str]:
+        with self._lock:
+            return {uuid for uuid in changeset_uuids if uuid in self._changesets}
+
+    def _apply_changesets_bulk(self, changesets: List[ChangeSet]) -> int:
+        changes = 0
+        for changeset in changesets:
+            self._record_changeset(changeset)
+            self._apply_changeset(changeset.uuid, applied_at=str(changeset.created))
+            changes += len(changeset.changes)
+        return changes
+
+    def _update_changeset(self, changeset: ChangeSet, replicated: Optional[bool] = None, applied: Optional[bool] = None) -> None:
+        with self._transaction():
+            if changeset.uuid not in self._changesets:
+                raise Exception(f"Unexpected result when updating changeset '{changeset.uuid}'")
+            if replicated is not None:
+                self._set_changeset_flag(changeset.uuid, 'replicated', replicated)
+            if applied is not None:
+                self._set_changeset_flag(changeset.uuid, 'applied', applied)
+
+    def _get_changesets_as_items(self) -> List[Item]:
+        with self._lock:
+            txs = [entry for entry in self._ids if entry.is_tx][-100:]
+            sets: List[Item] = []
+            for entry in reversed(txs):
+                facts = {Fact(tag, prop, val) for (tag, prop), (val, _) in self._live[entry.dbid].items()}
+                if facts:
+                    sets.append(Item(facts=facts))
+            return sets
+
+    def _get_unreplicated_changesets(self) -> List[ChangeSet]:
+        with self._lock:
+            return [
+                self._copy_changeset(entry.changeset, origin_rowid=entry.rowid)
+                for entry in self._changesets.values()
+                if entry.changeset.origin == self.uuid and entry.changeset.applied and not entry.changeset.replicated
+            ]
+
+    def _get_last_ingested_changeset(self, dbuuid: str) -> int:
+        with self._lock:
+            return max((entry.changeset.origin_rowid or 0 for entry in self._changesets.values() if entry.changeset.origin == dbuuid), default=0)
+
+    def _compact(self, horizon: str) -> int:
+        # The fact log only lives in memory, so there is no hot table to shrink
+        return 0
+
+    def _get_history(self, ref: Optional[Fact] = None) -> List[Item]:
+        with self._lock:
+            if ref:
+                dbid = self._by_ref.get(ref.value)
+                if dbid is None or self._ids[dbid - 1].is_tx:
+                    return []
+                entries = [self._log[pos] for positions in self._log_keys[dbid].values() for pos in positions]
+            else:
+                # Get last 100 transactions
+                txs = {entry.dbid for entry in self._ids if entry.is_tx}
+                recent = set(sorted(txs)[-100:])
+                entries = [e for e in self._log if e.changeset in recent and not self._ids[e.dbid - 1].is_tx]
+
+            entries.sort(key=lambda e: (e.tag, e.prop, e.val, e.dbid, -e.changeset))
+
+            sets: List[Item] = []
+            for e in entries:
+                tx = self._ids[e.changeset - 1]
+                if not ref:
+                    desc = f'@{self._ids[e.dbid - 1].ref}: '
+                else:
+                    desc = ''
+                desc += 'Added ' if not e.revoke else 'Revoked '
+                desc += repr(Fact(e.tag, e.prop, e.val, tx=tx.ref))
+                facts = {
+                    Ref(tx.ref),
+                    Content(desc),
+                    Value('_db', 'created', tx.created)
+                }
+
+                sets.append(Item(facts=facts))
+
+            return sets
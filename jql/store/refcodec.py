@@ -0,0 +1,45 @@
+from functools import lru_cache
+from hashids import Hashids  # type: ignore
+import string
+from typing import Iterable, List
+
+from jql.types import Fact, Ref
+
+
+class RefCodec:
+    """
+    Converts between item ids and their hashid refs for a single store salt.
+    Recently converted values are kept in an LRU cache, as the same refs
+    tend to be converted over and over.
+    """
+    def __init__(self, salt: str, cache_size: int = 4096) -> None:
+        self.salt = salt
+        self._hashids = Hashids(salt=salt, alphabet=string.hexdigits[:16], min_length=6)
+        self._encode = lru_cache(maxsize=cache_size)(self._encode_id)
+        self._decode = lru_cache(maxsize=cache_size)(self._decode_ref)
+
+    def _encode_id(self, i: int) -> str:
+        return str(self._hashids.encode(i))
+
+    def _decode_ref(self, ref: str) -> int:
+        return int(self._hashids.decode(ref)[0])
+
+    def encode(self, i: int) -> Fact:
+        return Ref(self._encode(i))
+
+    def decode(self, ref: Fact) -> int:
+        return self._decode(ref.value)
+
+    def encode_many(self, ids: Iterable[int]) -> List[Fact]:
+        encode = self._encode
+        return [Ref(encode(i)) for i in ids]
+
+    def decode_many(self, refs: Iterable[Fact]) -> List[int]:
+        decode = self._decode
+        return [decode(ref.value) for ref in refs]
+
+
+@lru_cache(maxsize=32)
+def get_codec(salt: str) -> RefCodec:
+    "Return the shared codec for a salt"
+    return RefCodec(salt)
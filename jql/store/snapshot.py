@@ -0,0 +1,42 @@
+import gzip
+import json
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+
+SNAPSHOT_FORMAT = 'jql-snapshot'
+SNAPSHOT_VERSION = 1
+
+# An item in a snapshot: uuid, created time, and current [tag, prop, val] facts
+SnapshotItem = Tuple[str, str, List[List[str]]]
+
+
+def write_snapshot(path: str, header: Dict[str, Any], items: Iterable[SnapshotItem]) -> int:
+    """
+    Write a gzipped JSON lines snapshot: a header line, then one line per
+    item. Returns the number of items written.
+    """
+    count = 0
+    with gzip.open(path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps({'format': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION, **header}) + '\n')
+        for uuid, created, facts in items:
+            f.write(json.dumps([uuid, created, facts], separators=(',', ':')) + '\n')
+            count += 1
+    return count
+
+
+def read_snapshot_header(path: str) -> Dict[str, Any]:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        header: Dict[str, Any] = json.loads(f.readline())
+    if header.get('format') != SNAPSHOT_FORMAT:
+        raise Exception(f'{path} is not a snapshot')
+    if header.get('version') != SNAPSHOT_VERSION:
+        raise Exception(f"Unsupported snapshot version {header.get('version')}")
+    return header
+
+
+def read_snapshot_items(path: str) -> Iterator[SnapshotItem]:
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        f.readline()
+        for line in f:
+            uuid, created, facts = json.loads(line)
+            yield (uuid, created, facts)
@@ -1,104 +1,458 @@
+from contextlib import contextmanager
 import datetime
+from itertools import islice
 import json
 import os
+from pathlib import Path
+import queue
 import sqlite3
-from typing import FrozenSet, List, Iterable, Set, Optional, Tuple
+from sys import intern
+import threading
+import uuid
+from typing import Any, Dict, FrozenSet, Iterator, List, Iterable, Sequence, Set, Optional, Tuple, Union
 
 
-from jql.changeset import ChangeSet
+from jql.changeset import Change, ChangeSet, decode_changes, encode_changes
 from jql.store import Store
-from jql.types import Content, Fact, Flag, Item, Ref, Value, is_tag, is_flag, is_content, has_value, Tag
+from jql.store.snapshot import read_snapshot_header, read_snapshot_items, SnapshotItem, write_snapshot
+from jql.types import Content, Fact, Flag, Item, Ref, Value, is_tag, is_flag, is_content, has_flag, has_value, get_created_time, Tag
+
+
+# Keep IN (...) lists well under SQLite's bound parameter limit
+CHUNK_SIZE = 500
+
+
+def chunks(values: Sequence[Any], size: int = CHUNK_SIZE) -> Iterator[Sequence[Any]]:
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
 
 
 class SqliteStore(Store):
-    def __init__(self, location: str = ":memory:", salt: str = "") -> None:
-        self._conn = sqlite3.connect(location)
+    """
+    SQLite backed store.
+
+    With wal=True (file databases only) the database is put in WAL mode. All
+    writes then go through the one writer connection, while reads are served
+    from a pool of up to read_pool_size read-only connections so they no
+    longer queue behind writers. wal_autocheckpoint sets how many WAL pages
+    trigger an automatic checkpoint; set it to 0 and call checkpoint() to
+    manage checkpoints yourself.
+    """
+    def __init__(self, location: str = ":memory:", salt: str = "", wal: bool = False, read_pool_size: int = 4, wal_autocheckpoint: int = 1000, item_cache_size: int = 0, group_commit_window: float = 0) -> None:
+        self._location = location
+        self._conn = sqlite3.connect(location, check_same_thread=False)
         self._conn.row_factory = sqlite3.Row
+        self._tx_depth = 0
+        self._tx_owner: Optional[int] = None
+        self._write_lock = threading.RLock()
+
+        self._wal = wal and location != ":memory:"
+        self._read_pool_size = read_pool_size if self._wal else 0
+        self._read_pool: queue.Queue[sqlite3.Connection] = queue.Queue()
+        self._read_conns: List[sqlite3.Connection] = []
+        self._read_pool_lock = threading.Lock()
 
         cur = self._conn.cursor()
         current_version = cur.execute('pragma user_version').fetchone()[0]
         if not current_version:
             import jql.store.sqlite_migration
             jql.store.sqlite_migration.schema_migration(self._conn)
-        elif current_version < 11:
+        elif current_version < 19:
             raise Exception('Database needs migration run')
 
+        content_index = cur.execute("SELECT val FROM config WHERE key='content_index'").fetchone()
+        self._content_index: Optional[str] = content_index['val'] if content_index else None
+
         # Look for existing salt
         cur.execute("SELECT val FROM config WHERE key='salt'")
         existing_salt = cur.fetchone()
         if existing_salt:
-            super().__init__(existing_salt["val"])
+            super().__init__(existing_salt["val"], item_cache_size=item_cache_size, group_commit_window=group_commit_window)
         else:
             # Run initial Setup with supplied salt (or generate one)
-            super().__init__(salt)
+            super().__init__(salt, item_cache_size=item_cache_size, group_commit_window=group_commit_window)
             cur.execute('INSERT INTO config (key, val) VALUES (?, ?)', ['salt', self._salt])
             cur.execute('INSERT INTO config (key, val) VALUES (?, ?)', ['created', datetime.datetime.now()])
 
         self._conn.commit()
 
-        if os.getenv("DEBUG") or os.getenv("FLASK_ENV") == "development":
+        if self._wal:
+            self._conn.execute('PRAGMA journal_mode = WAL')
+            self._conn.execute(f'PRAGMA wal_autocheckpoint = {int(wal_autocheckpoint)}')
+
+        if self._debug:
             self._conn.set_trace_callback(print)
 
+    @property
+    def _debug(self) -> bool:
+        return bool(os.getenv("DEBUG") or os.getenv("FLASK_ENV") == "development")
+
+    def checkpoint(self, mode: str = 'PASSIVE') -> None:
+        """
+        Checkpoint the WAL into the database file
+        """
+        if mode not in ('PASSIVE', 'FULL', 'RESTART', 'TRUNCATE'):
+            raise Exception(f'Unknown checkpoint mode {mode}')
+        with self._write_lock:
+            self._conn.execute(f'PRAGMA wal_checkpoint({mode})')
+
+    def close(self) -> None:
+        with self._read_pool_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns = []
+            self._read_pool = queue.Queue()
+        with self._write_lock:
+            self._conn.close()
+
+    def export_snapshot(self, path: str) -> int:
+        """
+        Write the current facts of every item, and how far this store has
+        got through each origin's changesets, to a snapshot file. Returns
+        the number of items written.
+        """
+        with self._reader() as conn:
+            # Read everything from one consistent view of the database
+            pooled = conn is not self._conn
+            if pooled:
+                conn.execute('BEGIN')
+            try:
+                cur = conn.cursor()
+                watermarks = {
+                    row['origin']: int(row['max'] or 0)
+                    for row in cur.execute('''
+                        SELECT origin, MAX(CASE WHEN origin = ? THEN rowid ELSE origin_rowid END) AS max
+                        FROM changesets
+                        WHERE applied = 1
+                        GROUP BY origin
+                    ''', (self.uuid,))
+                }
+                watermarks.setdefault(self.uuid, 0)
+                header = {'origin': self.uuid, 'created': str(datetime.datetime.now()), 'watermarks': watermarks}
+                rows = cur.execute('''
+                    SELECT i.rowid AS dbid, i.uuid AS uuid, i.created AS created, f.tag AS tag, f.prop AS prop, f.val AS val
+                    FROM idlist i
+                    INNER JOIN live_facts f
+                    ON f.dbid = i.rowid
+                    WHERE i.changeset_uuid IS NULL
+                    AND NOT (f.tag = '_db' AND f.prop = 'id')
+                    ORDER BY i.rowid
+                ''')
+                return write_snapshot(path, header, self._snapshot_items(rows))
+            finally:
+                if pooled:
+                    conn.execute('COMMIT')
+
+    def _snapshot_items(self, rows: Iterable[sqlite3.Row]) -> Iterator[SnapshotItem]:
+        current: Optional[Tuple[int, str, str]] = None
+        facts: List[List[str]] = []
+        for row in rows:
+            if current is None or current[0] != row['dbid']:
+                if current is not None:
+                    yield (current[1], current[2], facts)
+                current = (row['dbid'], row['uuid'], row['created'])
+                facts = []
+            facts.append([row['tag'], row['prop'], row['val']])
+        if current is not None:
+            yield (current[1], current[2], facts)
+
+    def load_snapshot(self, path: str, batch_size: int = 10000) -> int:
+        """
+        Bulk load a snapshot written by export_snapshot into this empty
+        store. Every loaded fact belongs to a single snapshot transaction,
+        and replication ingestion carries on from the snapshot's
+        watermarks. Returns the number of items loaded.
+        """
+        header = read_snapshot_header(path)
+        created = datetime.datetime.fromisoformat(header['created'])
+
+        # One marker changeset per origin records where ingestion resumes,
+        # the snapshot's own origin first so it owns the loaded facts
+        markers = [
+            ChangeSet(
+                uuid=str(uuid.uuid4()),
+                client='snapshot:system',
+                origin=origin,
+                origin_rowid=int(rowid),
+                created=created,
+                query=f"SNAPSHOT {header['origin']}",
+                changes=[],
+            )
+            for origin, rowid in sorted(header['watermarks'].items(), key=lambda w: w[0] != header['origin'])
+        ]
+
+        loaded = 0
+        with self._transaction():
+            cur = self._conn.cursor()
+            if cur.execute('SELECT COUNT(*) AS c FROM idlist').fetchone()['c']:
+                raise Exception('Snapshots can only be loaded into an empty store')
+
+            self._apply_changesets_bulk(markers)
+            params = ', '.join('?' * len(markers))
+            cur.execute(f'UPDATE changesets SET replicated = 1 WHERE uuid IN ({params})', [m.uuid for m in markers])  # noqa: S608
+            csid = int(cur.execute('SELECT rowid FROM idlist WHERE changeset_uuid = ?', (markers[0].uuid,)).fetchone()['rowid'])
+
+            items = read_snapshot_items(path)
+            while True:
+                batch = list(islice(items, batch_size))
+                if not batch:
+                    break
+
+                next_id = int(cur.execute('SELECT COALESCE(MAX(rowid), 0) AS max FROM idlist').fetchone()['max']) + 1
+                dbids = range(next_id, next_id + len(batch))
+                ids = []
+                values = []
+                for dbid, ref, (uid, item_created, facts) in zip(dbids, self._codec.encode_many(dbids), batch):
+                    ids.append((dbid, ref.value, uid, None, item_created))
+                    values.append((csid, dbid, ref.tag, ref.prop, ref.value))
+                    values.extend((csid, dbid, tag, prop, val) for tag, prop, val in facts)
+
+                cur.executemany('INSERT INTO idlist (rowid, ref, uuid, changeset_uuid, created, archived) VALUES (?, ?, ?, ?, ?, 0)', ids)
+                cur.executemany('INSERT INTO facts (changeset, dbid, tag, prop, val, revoke, current) VALUES (?, ?, ?, ?, ?, 0, 1)', values)
+                self._refresh_items(set(dbids))
+                loaded += len(batch)
+
+        return loaded
+
+    @contextmanager
+    def _transaction(self) -> Iterator[None]:
+        # Nested calls join the outermost transaction, which does the commit
+        if self._tx_owner == threading.get_ident():
+            self._tx_depth += 1
+            try:
+                yield
+            finally:
+                self._tx_depth -= 1
+            return
+
+        with self._write_lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._tx_owner = threading.get_ident()
+            self._tx_depth = 1
+            try:
+                yield
+            except BaseException:
+                self._conn.rollback()
+                raise
+            else:
+                self._conn.commit()
+            finally:
+                self._tx_depth = 0
+                self._tx_owner = None
+
+    @contextmanager
+    def _reader(self) -> Iterator[sqlite3.Connection]:
+        """
+        Connection to run a read on. Reads made during our own write
+        transaction have to see its uncommitted changes, so they (and all
+        reads when there is no pool) use the writer connection.
+        """
+        if not self._read_pool_size or self._tx_owner == threading.get_ident():
+            with self._write_lock:
+                yield self._conn
+            return
+
+        conn = self._checkout_reader()
+        try:
+            yield conn
+        finally:
+            self._read_pool.put(conn)
+
+    def _checkout_reader(self) -> sqlite3.Connection:
+        try:
+            return self._read_pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._read_pool_lock:
+            if len(self._read_conns) < self._read_pool_size:
+                conn = sqlite3.connect(f'{Path(self._location).resolve().as_uri()}?mode=ro', uri=True, check_same_thread=False, isolation_level=None)
+                conn.row_factory = sqlite3.Row
+                if self._debug:
+                    conn.set_trace_callback(print)
+                self._read_conns.append(conn)
+                return conn
+
+        # Pool is full, wait for a connection to be returned
+        return self._read_pool.get()
+
+    @contextmanager
+    def _savepoint(self, name: str) -> Iterator[None]:
+        with self._transaction():
+            self._conn.execute(f'SAVEPOINT {name}')
+            try:
+                yield
+            except BaseException:
+                self._conn.execute(f'ROLLBACK TO {name}')
+                self._conn.execute(f'RELEASE {name}')
+                raise
+            self._conn.execute(f'RELEASE {name}')
+
     def _next_ref(self, uid: str, created: str, changeset: bool = False) -> Tuple[Fact, int]:
-        cur = self._conn.cursor()
+        with self._transaction():
+            cur = self._conn.cursor()
 
-        if changeset:
-            uids = [None, uid]
-        else:
-            uids = [uid, None]
+            if changeset:
+                uids = [None, uid]
+            else:
+                uids = [uid, None]
 
-        cur.execute('INSERT INTO idlist (created, uuid, changeset_uuid, archived) VALUES (?, ?, ?, 0)', [created, uids[0], uids[1]])
-        if not cur.lastrowid:
-            raise Exception("No row inserted!")
+            cur.execute('INSERT INTO idlist (created, uuid, changeset_uuid, archived) VALUES (?, ?, ?, 0)', [created, uids[0], uids[1]])
+            if not cur.lastrowid:
+                raise Exception("No row inserted!")
 
-        itemid = int(cur.lastrowid)
+            itemid = int(cur.lastrowid)
 
-        new_ref = self._id_to_ref(itemid)
-        if self._get_item(new_ref):
-            raise Exception(f"{new_ref} item should not already exist")
+            new_ref = self._id_to_ref(itemid)
+            if self._get_item(new_ref):
+                raise Exception(f"{new_ref} item should not already exist")
 
-        if itemid != self._ref_to_id(new_ref):
-            raise Exception("Ref and ID do not match")
+            if itemid != self._ref_to_id(new_ref):
+                raise Exception("Ref and ID do not match")
 
-        # Update row in reflist with generated hash
-        if changeset:
-            cur.execute('UPDATE idlist SET ref = ? WHERE rowid = ? AND uuid IS NULL AND changeset_uuid = ?', (new_ref.value, itemid, uids[1]))
-        else:
-            cur.execute('UPDATE idlist SET ref = ? WHERE rowid = ? AND uuid = ? AND changeset_uuid IS NULL', (new_ref.value, itemid, uids[0]))
+            # Update row in reflist with generated hash
+            if changeset:
+                cur.execute('UPDATE idlist SET ref = ? WHERE rowid = ? AND uuid IS NULL AND changeset_uuid = ?', (new_ref.value, itemid, uids[1]))
+            else:
+                cur.execute('UPDATE idlist SET ref = ? WHERE rowid = ? AND uuid = ? AND changeset_uuid IS NULL', (new_ref.value, itemid, uids[0]))
 
-        if cur.rowcount != 1:
-            raise Exception(f"Unexpected result when storing new reference value '{new_ref.value}'")
+            if cur.rowcount != 1:
+                raise Exception(f"Unexpected result when storing new reference value '{new_ref.value}'")
 
-        self._conn.commit()
         return (new_ref, itemid)
 
-    def _get_item(self, ref: Fact) -> Optional[Item]:
-        cur = self._conn.cursor()
-        facts: Set[Fact] = set()
-        for row in cur.execute('SELECT tag, prop, val, tx_ref FROM current_facts_inc_tx WHERE ref = ?', [ref.value]):
-            facts.add(self._fact_from_row(row))
-        if len(facts) == 0:
-            return None
-        return Item(facts=facts)
+    def _get_item(self, ref: Fact, as_of: Optional[Fact] = None) -> Optional[Item]:
+        with self._reader() as conn:
+            cur = conn.cursor()
+            facts: Set[Fact] = set()
+            if as_of is None:
+                rows = cur.execute('SELECT tag, prop, val, tx_ref FROM live_facts WHERE ref = ?', [ref.value])
+            else:
+                rows = cur.execute(f'''
+                    SELECT c.tag AS tag, c.prop AS prop, c.val AS val, t.ref AS tx_ref
+                    FROM idlist i
+                    INNER JOIN fact_log c
+                    ON c.dbid = i.rowid
+                    INNER JOIN idlist t
+                    ON t.rowid = c.changeset
+                    WHERE i.ref = ?
+                      AND {self._as_of_sql('c', self._tx_rowid(conn, as_of))}
+                ''', [ref.value])  # noqa: S608
+            for row in rows:
+                facts.add(self._fact_from_row(row))
+            if len(facts) == 0:
+                return None
+            return Item(facts=facts)
 
     def _uuid_to_ref(self, uuid: str) -> Optional[Fact]:
-        ref = self._conn.execute("SELECT ref FROM idlist WHERE uuid=?", (uuid,)).fetchone()
-        return Ref(ref['ref']) if ref else None
+        with self._reader() as conn:
+            ref = conn.execute("SELECT ref FROM idlist WHERE uuid=?", (uuid,)).fetchone()
+            return Ref(ref['ref']) if ref else None
 
     def _ref_to_uuid(self, ref: Fact) -> Optional[str]:
-        uuid = self._conn.execute("SELECT uuid FROM idlist WHERE ref=?", (ref.value,)).fetchone()
-        return uuid['uuid'] if uuid else None
+        with self._reader() as conn:
+            uuid = conn.execute("SELECT uuid FROM idlist WHERE ref=?", (ref.value,)).fetchone()
+            return uuid['uuid'] if uuid else None
 
     def _get_item_by_uuid(self, uuid: str) -> Optional[Item]:
         ref = self._uuid_to_ref(uuid)
         return self._get_item(ref) if ref else None
 
-    def _get_items(self, search: Iterable[Fact]) -> List[Item]:
+    def _get_items(self, search: Iterable[Fact], limit: Optional[int] = None, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> List[Item]:
         matches = []
 
-        # Generate where clause
+        with self._reader() as conn:
+            as_of_id = self._tx_rowid(conn, as_of) if as_of is not None else None
+
+            where, d = self._search_sql(search, as_of_id)
+
+            if after is not None:
+                cursor = conn.execute('SELECT rowid, created FROM idlist WHERE ref = ?', (after.value,)).fetchone()
+                if not cursor:
+                    raise Exception(f'{after} does not exist')
+                where.append(" AND (i.created, i.rowid) > (?, ?) ")
+                d.append(cursor['created'])
+                d.append(cursor['rowid'])
+
+            # Pick the page of items first using the (created, rowid) keyset,
+            # then fetch the facts for just those items
+            if as_of_id is None:
+                page_sql = '''
+                SELECT i.rowid AS dbid, i.created AS created
+                FROM idlist i
+                WHERE i.archived = 0
+                  AND i.changeset_uuid IS NULL
+                '''
+                params = d
+            else:
+                page_sql = f'''
+                SELECT i.rowid AS dbid, i.created AS created
+                FROM idlist i
+                WHERE i.changeset_uuid IS NULL
+                  AND NOT EXISTS (SELECT 1 FROM fact_log a WHERE a.dbid = i.rowid AND a.tag = '_db' AND a.prop = 'archived' AND {self._as_of_sql('a', as_of_id)})
+                '''  # noqa: S608
+                params = d
+
+            for w in where:
+                page_sql += w
+
+            page_sql += '''
+            ORDER BY i.created, i.rowid
+            '''
+            if limit is not None:
+                page_sql += ' LIMIT ? '
+                params.append(limit)
+
+            if as_of_id is None:
+                items_sql = f'''
+                WITH page AS ({page_sql})
+                SELECT c.dbid AS dbid, c.tag AS tag, c.prop AS prop, c.val AS val, c.tx_ref AS tx_ref
+                FROM page p
+                INNER JOIN live_facts c
+                ON c.dbid = p.dbid
+                ORDER BY p.created, p.dbid
+                '''  # noqa: S608
+            else:
+                items_sql = f'''
+                WITH page AS ({page_sql})
+                SELECT c.dbid AS dbid, c.tag AS tag, c.prop AS prop, c.val AS val, t.ref AS tx_ref
+                FROM page p
+                INNER JOIN fact_log c
+                ON c.dbid = p.dbid
+                INNER JOIN idlist t
+                ON t.rowid = c.changeset
+                WHERE {self._as_of_sql('c', as_of_id)}
+                ORDER BY p.created, p.dbid
+                '''  # noqa: S608
+
+            facts: Dict[int, Set[Fact]] = {}
+            for row in conn.execute(items_sql, params):
+                facts.setdefault(row["dbid"], set()).add(self._fact_from_row(row))
+
+            for fs in facts.values():
+                matches.append(Item(facts=fs))
+
+            return matches
+
+    def _get_matching_uuids(self, search: List[Fact]) -> List[str]:
+        with self._reader() as conn:
+            where, params = self._search_sql(search)
+            sql = f'''
+                SELECT i.uuid AS uuid
+                FROM idlist i
+                WHERE i.archived = 0
+                  AND i.changeset_uuid IS NULL
+                  {''.join(where)}
+                ORDER BY i.created, i.rowid
+            '''  # noqa: S608
+            return [row['uuid'] for row in conn.execute(sql, params)]
+
+    def _search_sql(self, search: Iterable[Fact], as_of_id: Optional[int] = None) -> Tuple[List[str], List[Any]]:
+        """
+        Conditions on idlist i, and their params, matching every search term
+        """
         where = []
-        d = []
+        d: List[Any] = []
         # For each item, loop through each search term
         s = 0
         for fact in search:
@@ -111,6 +465,10 @@ class SqliteStore(Store):
                 w = f"{prefix}.tag = ? AND {prefix}.prop = ?"
                 d.append(fact.tag)
                 d.append(fact.prop)
+            elif is_content(fact) and self._content_index and fact.value and as_of_id is None:
+                where.append(f" AND i.rowid IN ({self._content_search_sql()}) ")
+                d.append(self._content_search_term(fact.value))
+                continue
             elif is_content(fact):
                 # Content is a caseless substr match
                 w = f"{prefix}.tag = '_db' AND {prefix}.prop = 'content' AND {prefix}.val LIKE ?"
@@ -123,32 +481,68 @@ class SqliteStore(Store):
             else:
                 raise Exception(f'Unexpected search token {fact}')
 
-            where.append(f" INNER JOIN current_facts AS {prefix} ON c.dbid = {prefix}.dbid AND {w} ")
-
-        cur = self._conn.cursor()
-        items_sql = '''
-        SELECT c.dbid AS dbid, c.tag AS tag, c.prop AS prop, c.val AS val, c.tx_ref AS tx_ref
-        FROM current_facts c
-        '''
-        for w in where:
-            items_sql += w
-
-        items_sql += '''
-        ORDER BY c.created
+            if as_of_id is None:
+                where.append(f" AND EXISTS (SELECT 1 FROM live_facts AS {prefix} WHERE {prefix}.dbid = i.rowid AND {w}) ")  # noqa: S608
+            else:
+                where.append(f" AND EXISTS (SELECT 1 FROM fact_log AS {prefix} WHERE {prefix}.dbid = i.rowid AND {w} AND {self._as_of_sql(prefix, as_of_id)}) ")  # noqa: S608
+
+        return (where, d)
+
+    def _as_of_sql(self, alias: str, as_of_id: int) -> str:
+        """
+        Condition that the fact_log row `alias` was current, and not revoked,
+        once the transaction with rowid as_of_id had been applied
+        """
+        latest = '''
+            SELECT MAX(x.rowid)
+            FROM {table} x INDEXED BY {index}
+            WHERE x.dbid = {alias}.dbid
+                AND x.tag = {alias}.tag
+                AND x.prop = {alias}.prop
+                AND x.changeset <= {as_of_id}
         '''
+        facts = latest.format(table='facts', index='idx_facts_as_of', alias=alias, as_of_id=int(as_of_id))
+        history = latest.format(table='facts_history', index='idx_facts_history_as_of', alias=alias, as_of_id=int(as_of_id))
+
+        # Compacted facts live in facts_history, so the latest fact could be
+        # in either table. The unary + stops the planner choosing the low
+        # selectivity revoke index.
+        return f'''+{alias}.revoke = 0 AND {alias}.fid = MAX(
+            COALESCE(({facts}), 0),
+            COALESCE(({history}), 0)
+        )'''
+
+    def _tx_rowid(self, conn: sqlite3.Connection, ref: Fact) -> int:
+        tx = conn.execute('SELECT rowid FROM transactions WHERE ref = ?', (ref.value,)).fetchone()
+        if not tx:
+            raise Exception(f'{ref} is not a transaction')
+        return int(tx['rowid'])
+
+    def _get_tx_ref_as_of(self, timestamp: str) -> Optional[Fact]:
+        with self._reader() as conn:
+            tx = conn.execute('''
+                SELECT ref
+                FROM idlist
+                WHERE rowid = (
+                    SELECT MAX(rowid)
+                    FROM idlist
+                    WHERE changeset_uuid IS NOT NULL
+                      AND created <= ?
+                )
+            ''', (timestamp,)).fetchone()
+            return Ref(tx['ref']) if tx else None
 
-        facts = {}  # type: ignore
-        for row in cur.execute(items_sql, d):
-            if row["dbid"] not in facts.keys():
-                if len(facts) >= 100:
-                    break
-                facts[row["dbid"]] = set()
-            facts[row["dbid"]].add(self._fact_from_row(row))
-
-        for fs in facts.values():
-            matches.append(Item(facts=fs))
+    def _content_search_sql(self) -> str:
+        if self._content_index == 'trigram':
+            # Trigram indexes answer substring LIKE queries directly
+            return 'SELECT rowid FROM content_index WHERE val LIKE ?'
+        return 'SELECT rowid FROM content_index WHERE content_index MATCH ?'
 
-        return matches
+    def _content_search_term(self, value: str) -> str:
+        if self._content_index == 'trigram':
+            return f'%{value}%'
+        # Word tokenizers can only match on word prefixes
+        return ' '.join('"{}"*'.format(w.replace('"', '""')) for w in value.split())
 
     def _create_item(self, changeset_ref: Fact, uid: str, item: Item) -> Item:
         self._add_facts(changeset_ref, uid, item.facts, create=True)
@@ -169,191 +563,466 @@ class SqliteStore(Store):
         return updated_item
 
     def _add_facts(self, changeset_ref: Fact, uid: str, facts: FrozenSet[Fact], revoke: bool = False, create: bool = False) -> None:
-        cur = self._conn.cursor()
-        res = cur.execute("SELECT rowid, archived FROM idlist WHERE uuid=? OR changeset_uuid=?", (uid, uid)).fetchone()
-        if not res:
-            raise Exception(f'Could not find item {uid} to update')
-        dbid = res['rowid']
-        archived = res['archived']
-
-        res = cur.execute("SELECT rowid FROM transactions WHERE ref=?", (changeset_ref.value,)).fetchone()
-        if not res:
-            raise Exception('Could not find transaction')
-        csid = res['rowid']
-
-        values = []
-
-        archive_changed = None
-        for f in facts:
-            if f.tag == "_db" and f.prop == "archived":
-                archive_changed = not revoke
-
-            values.append((csid, dbid, f.tag, f.prop, f.value, revoke))
-
-        cur.executemany('INSERT INTO facts (changeset, dbid, tag, prop, val, revoke, current) VALUES (?, ?, ?, ?, ?, ?, 1)', values)
+        with self._transaction():
+            cur = self._conn.cursor()
+            item = cur.execute("SELECT rowid, ref, created, archived, changeset_uuid FROM idlist WHERE uuid=? OR changeset_uuid=?", (uid, uid)).fetchone()
+            if not item:
+                raise Exception(f'Could not find item {uid} to update')
+            dbid = item['rowid']
+            archived = item['archived']
+            is_tx = int(item['changeset_uuid'] is not None)
+
+            res = cur.execute("SELECT rowid FROM transactions WHERE ref=?", (changeset_ref.value,)).fetchone()
+            if not res:
+                raise Exception('Could not find transaction')
+            csid = res['rowid']
+
+            # Take the item out of the tag stats while it changes
+            if not is_tx:
+                self._adjust_tag_stats('?', [dbid], -1)
+
+            values = []
+
+            archive_changed = None
+            for f in facts:
+                if f.tag == "_db" and f.prop == "archived":
+                    archive_changed = not revoke
+
+                values.append((csid, dbid, f.tag, f.prop, f.value, revoke))
+
+            first = int(cur.execute('SELECT COALESCE(MAX(rowid), 0) AS max FROM facts').fetchone()['max']) + 1
+            cur.executemany('INSERT INTO facts (changeset, dbid, tag, prop, val, revoke, current) VALUES (?, ?, ?, ?, ?, ?, 0)', values)
+            self._supersede_facts(first)
+
+            # Calculate if we need to change the archived state
+            if archive_changed is not None and archive_changed != archived:
+                archived = int(archive_changed)
+                cur.execute('UPDATE idlist SET archived = ? WHERE uuid = ?', (archived, uid))
+                cur.execute('UPDATE live_facts SET archived = ? WHERE dbid = ?', (archived, dbid))
+
+            # Keep the content search index in step with the item's content
+            if self._content_index and not is_tx:
+                content = [f for f in facts if is_content(f)]
+                if content:
+                    cur.execute('DELETE FROM content_index WHERE rowid = ?', (dbid,))
+                    if not revoke:
+                        cur.execute('INSERT INTO content_index (rowid, val) VALUES (?, ?)', (dbid, content[-1].value))
+
+            # Keep live_facts in step with the current, non-revoked facts
+            if revoke:
+                cur.executemany('DELETE FROM live_facts WHERE dbid = ? AND tag = ? AND prop = ?', [(dbid, f.tag, f.prop) for f in facts])
+            else:
+                live = [(dbid, item['ref'], f.tag, f.prop, f.value, changeset_ref.value, archived, item['created'], is_tx) for f in facts]
+                cur.executemany('INSERT OR REPLACE INTO live_facts (dbid, ref, tag, prop, val, tx_ref, archived, created, is_tx) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', live)
 
-        # Calculate if we need to change the archived state
-        if archive_changed is not None and archive_changed != archived:
-            cur.execute('UPDATE idlist SET archived = 1 WHERE uuid = ?', (uid, ))
+            if not is_tx:
+                self._adjust_tag_stats('?', [dbid], 1)
 
-        self._conn.commit()
+    def _adjust_tag_stats(self, dbids_sql: str, params: List[Any], sign: int) -> None:
+        """
+        Add (sign=1) or remove (sign=-1) the live facts of the items matching
+        `dbid IN (dbids_sql)` to the tag_stats counts
+        """
+        cur = self._conn.cursor()
+        cur.execute(f'''
+            INSERT INTO tag_stats (tag, prop, count)
+            SELECT tag, '', ? * COUNT(DISTINCT dbid)
+                FROM live_facts
+                WHERE dbid IN ({dbids_sql})
+                AND archived = 0
+                AND is_tx = 0
+                GROUP BY tag
+            UNION ALL
+            SELECT tag, prop, ? * COUNT(*)
+                FROM live_facts
+                WHERE dbid IN ({dbids_sql})
+                AND archived = 0
+                AND is_tx = 0
+                AND prop != ''
+                GROUP BY tag, prop
+            ON CONFLICT (tag, prop) DO UPDATE SET count = count + excluded.count
+        ''', [sign, *params, sign, *params])  # noqa: S608
+        if sign < 0:
+            cur.execute('DELETE FROM tag_stats WHERE count <= 0')
 
     def _get_tags_as_items(self, prefix: str = '') -> List[Item]:
         tags: List[Item] = []
 
-        cur = self._conn.cursor()
-        tags_sql = '''
-            SELECT tag, COUNT(DISTINCT dbid) AS c
-            FROM current_facts
-        '''
+        with self._reader() as conn:
+            cur = conn.cursor()
+            tags_sql = '''
+                SELECT tag, count AS c
+                FROM tag_stats
+                WHERE prop = ''
+            '''
 
-        if len(prefix):
-            tags_sql += ' WHERE tag LIKE ? '
-            params = [f'{prefix}%']
-        else:
-            params = []
+            if len(prefix):
+                tags_sql += ' AND tag LIKE ? '
+                params = [f'{prefix}%']
+            else:
+                params = []
 
-        tags_sql += '''
-            GROUP BY tag
-            ORDER BY tag
-        '''
+            tags_sql += '''
+                ORDER BY tag
+            '''
 
-        for row in cur.execute(tags_sql, params):
-            tags.append(Item(facts={Tag(row["tag"]), Value('_db', 'count', str(row["c"]))}))
-        return tags
+            for row in cur.execute(tags_sql, params):
+                tags.append(Item(facts={Tag(row["tag"]), Value('_db', 'count', str(row["c"]))}))
+            return tags
 
     def _get_props_as_items(self, tag: str, prefix: str = '') -> List[Item]:
         props: List[Item] = []
 
-        cur = self._conn.cursor()
-        props_sql = '''
-            SELECT prop, COUNT(DISTINCT dbid) AS c
-            FROM current_facts
-            WHERE tag = ? AND prop != ""
-        '''
+        with self._reader() as conn:
+            cur = conn.cursor()
+            props_sql = '''
+                SELECT prop, count AS c
+                FROM tag_stats
+                WHERE tag = ? AND prop != ""
+            '''
 
-        if len(prefix):
-            props_sql += ' AND prop LIKE ? '
-            params = [tag, f'{prefix}%']
-        else:
-            params = [tag]
+            if len(prefix):
+                props_sql += ' AND prop LIKE ? '
+                params = [tag, f'{prefix}%']
+            else:
+                params = [tag]
 
-        props_sql += '''
-            GROUP BY prop
-            ORDER BY prop
-        '''
+            props_sql += '''
+                ORDER BY prop
+            '''
 
-        for row in cur.execute(props_sql, params):
-            props.append(Item(facts={Flag(tag, row["prop"]), Value('_db', 'count', str(row["c"]))}))
-        return props
+            for row in cur.execute(props_sql, params):
+                props.append(Item(facts={Flag(tag, row["prop"]), Value('_db', 'count', str(row["c"]))}))
+            return props
 
     def _record_changeset(self, changeset: ChangeSet) -> str:
-        cur = self._conn.cursor()
-        cur.execute('INSERT INTO changesets (uuid, client, created, query, changes, origin, origin_rowid) VALUES (?, ?, ?, ?, ?, ?, ?)', (changeset.uuid, changeset.client, changeset.created, changeset.query, json.dumps(changeset.changes_as_dict()), changeset.origin, changeset.origin_rowid))
-        self._conn.commit()
+        with self._transaction():
+            cur = self._conn.cursor()
+            cur.execute('INSERT INTO changesets (uuid, client, created, query, changes, origin, origin_rowid, hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (changeset.uuid, changeset.client, changeset.created, changeset.query, encode_changes(changeset.changes), changeset.origin, changeset.origin_rowid, changeset.content_hash()))
         return changeset.uuid
 
-    def _load_changeset(self, changeset_uuid: str) -> ChangeSet:
-        cur = self._conn.cursor()
-        cur.execute('SELECT rowid, uuid, client, created, query, changes, origin, origin_rowid, applied, replicated FROM changesets WHERE uuid = ?', (changeset_uuid,))
-        cs = cur.fetchone()
-        if not cs:
-            raise KeyError(f'Could not find changeset {changeset_uuid}')
-        return self._changset_from_row(cs)
+    def _get_existing_changesets(self, changeset_uuids: List[str]) -> Set[str]:
+        existing = set()
+        with self._reader() as conn:
+            for chunk in chunks(changeset_uuids):
+                params = ', '.join('?' * len(chunk))
+                for row in conn.execute(f'SELECT uuid FROM changesets WHERE uuid IN ({params})', chunk):  # noqa: S608
+                    existing.add(row['uuid'])
+        return existing
+
+    def _apply_changes(self, cs_ref: Fact, changeset: ChangeSet) -> List[Item]:
+        """
+        Changesets that update many existing items, such as SET on every
+        match, are applied with batched inserts rather than item by item
+        """
+        uuids = [change.uuid for change in changeset.changes]
+        if len(uuids) < 2 or len(set(uuids)) < len(uuids) or any(has_flag(iter(c.facts), '_db', 'created') for c in changeset.changes if not c.revoke):
+            return super()._apply_changes(cs_ref, changeset)
 
-    def _get_changesets_as_items(self) -> List[Item]:
+        cur = self._conn.cursor()
+        csid = self._tx_rowid(self._conn, cs_ref)
+        uuid_to_dbid: Dict[str, int] = {}
+        for chunk in chunks(uuids):
+            params = ', '.join('?' * len(chunk))
+            for row in cur.execute(f'SELECT rowid, uuid FROM idlist WHERE uuid IN ({params})', chunk):  # noqa: S608
+                uuid_to_dbid[row['uuid']] = row['rowid']
+
+        values: List[Tuple[int, int, str, str, str, bool]] = []
+        for change in changeset.changes:
+            if change.uuid not in uuid_to_dbid:
+                raise Exception(f'Could not find item {change.uuid} to update')
+            dbid = uuid_to_dbid[change.uuid]
+            values.extend((csid, dbid, f.tag, f.prop, f.value, change.revoke) for f in change.facts)
+
+        first = int(cur.execute('SELECT COALESCE(MAX(rowid), 0) AS max FROM facts').fetchone()['max']) + 1
+        cur.executemany('INSERT INTO facts (changeset, dbid, tag, prop, val, revoke, current) VALUES (?, ?, ?, ?, ?, ?, 0)', values)
+        self._supersede_facts(first)
+        self._refresh_items(set(uuid_to_dbid.values()))
+
+        facts: Dict[int, Set[Fact]] = {}
+        cur.execute('''
+            SELECT dbid, tag, prop, val, tx_ref
+            FROM live_facts
+            WHERE dbid IN (SELECT dbid FROM temp.refresh_items)
+        ''')
+        for row in cur:
+            facts.setdefault(row['dbid'], set()).add(self._fact_from_row(row))
+        return [Item(facts=facts.get(uuid_to_dbid[uid], set())) for uid in uuids]
+
+    def _apply_changesets_bulk(self, changesets: List[ChangeSet]) -> int:
         cur = self._conn.cursor()
 
-        cs_sql = '''
-            SELECT dbid, tag, prop, val
-            FROM current_facts_inc_tx
-            WHERE is_tx = 1
-              AND dbid IN (
-                SELECT rowid
-                FROM transactions
-                ORDER BY rowid DESC
-                LIMIT 100
+        # Allocate idlist rows up front, in the same order apply_changeset would
+        next_id = int(cur.execute('SELECT COALESCE(MAX(rowid), 0) AS max FROM idlist').fetchone()['max']) + 1
+        creates = sum(1 for cs in changesets for c in cs.changes if not c.revoke and has_flag(iter(c.facts), '_db', 'created'))
+        refs = iter(self._codec.encode_many(range(next_id, next_id + len(changesets) + creates)))
+        ids: List[Tuple[int, str, Optional[str], Optional[str], str]] = []
+        uuid_to_dbid: Dict[str, int] = {}
+        changes: List[Tuple[int, str, FrozenSet[Fact], bool]] = []
+        for changeset in changesets:
+            content = json.dumps(changeset.changes_as_dict())
+            cur.execute('INSERT INTO changesets (uuid, client, created, query, changes, origin, origin_rowid, applied, hash) VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)', (changeset.uuid, changeset.client, changeset.created, changeset.query, encode_changes(changeset.changes), changeset.origin, changeset.origin_rowid, changeset.content_hash()))
+
+            csid = next_id
+            cs_ref = next(refs)
+            next_id += 1
+            ids.append((csid, cs_ref.value, None, changeset.uuid, str(changeset.created)))
+            uuid_to_dbid[changeset.uuid] = csid
+            # Stamp the tx item with the changeset's own time, not the time of the restore
+            changes.append((csid, changeset.uuid, frozenset(self._changeset_facts(cs_ref, changeset, content, created=str(changeset.created))), False))
+
+            for change in changeset.changes:
+                facts = frozenset(change.facts)
+                if not change.revoke and has_flag(iter(change.facts), '_db', 'created'):
+                    new_ref = next(refs)
+                    ids.append((next_id, new_ref.value, change.uuid, None, get_created_time(iter(change.facts)).value))
+                    uuid_to_dbid[change.uuid] = next_id
+                    facts = facts.union({new_ref})
+                    next_id += 1
+                changes.append((csid, change.uuid, facts, change.revoke))
+
+        cur.executemany('INSERT INTO idlist (rowid, ref, uuid, changeset_uuid, created, archived) VALUES (?, ?, ?, ?, ?, 0)', ids)
+
+        # Look up any items being updated that were created before this batch
+        missing = list({uid for _, uid, _, _ in changes if uid not in uuid_to_dbid})
+        for chunk in chunks(missing):
+            params = ', '.join('?' * len(chunk))
+            for row in cur.execute(f'SELECT rowid, uuid FROM idlist WHERE uuid IN ({params})', chunk):  # noqa: S608
+                uuid_to_dbid[row['uuid']] = row['rowid']
+
+        values: List[Tuple[int, int, str, str, str, bool]] = []
+        for csid, uid, facts, revoke in changes:
+            if uid not in uuid_to_dbid:
+                raise Exception(f'Could not find item {uid} to update')
+            dbid = uuid_to_dbid[uid]
+            values.extend((csid, dbid, f.tag, f.prop, f.value, revoke) for f in facts)
+
+        # Insert as non-current and work out which facts are current afterwards
+        first = int(cur.execute('SELECT COALESCE(MAX(rowid), 0) AS max FROM facts').fetchone()['max']) + 1
+        cur.executemany('INSERT INTO facts (changeset, dbid, tag, prop, val, revoke, current) VALUES (?, ?, ?, ?, ?, ?, 0)', values)
+        self._supersede_facts(first)
+        self._refresh_items(set(uuid_to_dbid.values()))
+
+        return len(changes) - len(changesets)
+
+    def _supersede_facts(self, first: int) -> None:
+        """
+        Mark the latest of the facts inserted from rowid `first` onwards as
+        current for each dbid/tag/prop, and any they override as not current
+        """
+        # CROSS JOIN and NOT INDEXED keep the planner starting from the new
+        # rowids, rather than scanning every current fact
+        cur = self._conn.cursor()
+        cur.execute('''
+            UPDATE facts
+            SET current = 0
+            WHERE rowid IN (
+                SELECT o.rowid
+                FROM facts n
+                CROSS JOIN facts o
+                    ON o.dbid = n.dbid
+                    AND o.tag = n.tag
+                    AND o.prop = n.prop
+                    AND o.current = 1
+                    AND o.rowid < n.rowid
+                WHERE n.rowid >= ?
             )
-            ORDER BY rowid DESC, dbid DESC
-        '''
-
-        sets: List[Item] = []
-        facts = {}  # type: ignore
-        for row in cur.execute(cs_sql):
-            if row["dbid"] not in facts.keys():
-                facts[row["dbid"]] = set()
-            facts[row["dbid"]].add(self._fact_from_row(row))
-
-        for fs in facts.values():
-            sets.append(Item(facts=fs))
-
-        return sets
+        ''', (first,))
+        cur.execute('''
+            UPDATE facts
+            SET current = 1
+            WHERE rowid IN (
+                SELECT MAX(rowid)
+                FROM facts NOT INDEXED
+                WHERE rowid >= ?
+                GROUP BY dbid, tag, prop
+            )
+        ''', (first,))
 
-    def _get_history(self, ref: Optional[Fact] = None) -> List[Item]:
+    def _refresh_items(self, dbids: Set[int]) -> None:
+        """
+        Rebuild archived state, live_facts, tag stats and the content index
+        for the supplied items from their current facts
+        """
         cur = self._conn.cursor()
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS refresh_items (dbid INTEGER PRIMARY KEY)')
+        cur.execute('DELETE FROM temp.refresh_items')
+        cur.executemany('INSERT INTO temp.refresh_items (dbid) VALUES (?)', [(dbid,) for dbid in dbids])
+        self._adjust_tag_stats('SELECT dbid FROM temp.refresh_items', [], -1)
+
+        cur.execute('''
+            UPDATE idlist
+            SET archived = EXISTS (
+                SELECT 1
+                FROM facts f
+                WHERE f.dbid = idlist.rowid
+                    AND f.tag = '_db'
+                    AND f.prop = 'archived'
+                    AND f.current = 1
+                    AND f.revoke = 0
+            )
+            WHERE rowid IN (SELECT dbid FROM temp.refresh_items)
+        ''')
+
+        cur.execute('DELETE FROM live_facts WHERE dbid IN (SELECT dbid FROM temp.refresh_items)')
+        cur.execute('''
+            INSERT INTO live_facts (dbid, ref, tag, prop, val, tx_ref, archived, created, is_tx)
+            SELECT f.dbid, i.ref, f.tag, f.prop, f.val, t.ref, i.archived, i.created, CASE WHEN i.changeset_uuid IS NOT NULL THEN 1 ELSE 0 END
+                FROM facts f
+                INNER JOIN idlist i
+                ON i.rowid = f.dbid
+                INNER JOIN idlist t
+                ON t.rowid = f.changeset
+                WHERE f.dbid IN (SELECT dbid FROM temp.refresh_items)
+                AND f.current = 1
+                AND f.revoke = 0
+        ''')
+        self._adjust_tag_stats('SELECT dbid FROM temp.refresh_items', [], 1)
+
+        if self._content_index:
+            cur.execute('DELETE FROM content_index WHERE rowid IN (SELECT dbid FROM temp.refresh_items)')
+            cur.execute('''
+                INSERT INTO content_index (rowid, val)
+                SELECT dbid, val
+                    FROM live_facts
+                    WHERE dbid IN (SELECT dbid FROM temp.refresh_items)
+                    AND tag = '_db'
+                    AND prop = 'content'
+                    AND is_tx = 0
+            ''')
+
+    def _compact(self, horizon: str) -> int:
+        cur = self._conn.cursor()
+        cur.execute('CREATE TEMP TABLE IF NOT EXISTS compact_facts (fid INTEGER PRIMARY KEY)')
+        cur.execute('DELETE FROM temp.compact_facts')
+
+        # New facts take MAX(rowid) + 1, so the newest fact always stays in
+        # facts to stop its rowid being reused
+        cur.execute('''
+            INSERT INTO temp.compact_facts (fid)
+            SELECT f.rowid
+                FROM facts f
+                INNER JOIN idlist t
+                ON t.rowid = f.changeset
+                WHERE (f.current = 0 OR f.revoke = 1)
+                AND t.created < ?
+                AND f.rowid < (SELECT MAX(rowid) FROM facts)
+        ''', (horizon,))
+        cur.execute('''
+            INSERT INTO facts_history (fid, changeset, dbid, tag, prop, val, revoke, current)
+            SELECT rowid, changeset, dbid, tag, prop, val, revoke, current
+                FROM facts
+                WHERE rowid IN (SELECT fid FROM temp.compact_facts)
+        ''')
+        cur.execute('DELETE FROM facts WHERE rowid IN (SELECT fid FROM temp.compact_facts)')
+        return cur.rowcount
 
-        cs_params = []
-        cs_sql = '''
-            SELECT i.ref AS ref, f.tag AS tag, f.prop AS prop, f.val AS val, f.revoke AS revoke, t.ref AS tx_ref, t.created AS tx_created
-            FROM facts f
-            INNER JOIN items i
-               ON i.rowid = f.dbid
-            INNER JOIN transactions t
-               ON t.rowid = f.changeset
-            WHERE
-        '''
+    def _load_changeset(self, changeset_uuid: str) -> ChangeSet:
+        with self._reader() as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT rowid, uuid, client, created, query, changes, origin, origin_rowid, applied, replicated FROM changesets WHERE uuid = ?', (changeset_uuid,))
+            cs = cur.fetchone()
+            if not cs:
+                raise KeyError(f'Could not find changeset {changeset_uuid}')
+            return self._changset_from_row(cs)
 
-        if ref:
-            cs_sql += '''
-                i.ref = ?
-            '''
-            cs_params.append(ref.value)
-        else:
-            # Get last 100 transactions
-            cs_sql += '''
-                f.changeset IN (
+    def _get_changesets_as_items(self) -> List[Item]:
+        with self._reader() as conn:
+            cur = conn.cursor()
+
+            cs_sql = '''
+                SELECT dbid, tag, prop, val
+                FROM live_facts
+                WHERE is_tx = 1
+                  AND dbid IN (
                     SELECT rowid
                     FROM transactions
                     ORDER BY rowid DESC
                     LIMIT 100
                 )
+                ORDER BY dbid DESC
             '''
 
-        cs_sql += '''
-            AND f.dbid != f.changeset
-            ORDER BY f.tag ASC, f.prop ASC, f.val ASC, f.dbid ASC, f.changeset DESC
-        '''
+            sets: List[Item] = []
+            facts = {}  # type: ignore
+            for row in cur.execute(cs_sql):
+                if row["dbid"] not in facts.keys():
+                    facts[row["dbid"]] = set()
+                facts[row["dbid"]].add(self._fact_from_row(row))
+
+            for fs in facts.values():
+                sets.append(Item(facts=fs))
+
+            return sets
+
+    def _get_history(self, ref: Optional[Fact] = None) -> List[Item]:
+        with self._reader() as conn:
+            cur = conn.cursor()
+
+            cs_params = []
+            cs_sql = '''
+                SELECT i.ref AS ref, f.tag AS tag, f.prop AS prop, f.val AS val, f.revoke AS revoke, t.ref AS tx_ref, t.created AS tx_created
+                FROM fact_log f
+                INNER JOIN items i
+                   ON i.rowid = f.dbid
+                INNER JOIN transactions t
+                   ON t.rowid = f.changeset
+                WHERE
+            '''
 
-        sets: List[Item] = []
-        for row in cur.execute(cs_sql, cs_params):
-            if not ref:
-                desc = f'@{row["ref"]}: '
+            if ref:
+                cs_sql += '''
+                    i.ref = ?
+                '''
+                cs_params.append(ref.value)
             else:
-                desc = ''
-            desc += 'Added ' if not row["revoke"] else 'Revoked '
-            desc += repr(self._fact_from_row(row))
-            facts = {
-                Ref(row["tx_ref"]),
-                Content(desc),
-                Value('_db', 'created', row["tx_created"])
-            }
+                # Get last 100 transactions
+                cs_sql += '''
+                    f.changeset IN (
+                        SELECT rowid
+                        FROM transactions
+                        ORDER BY rowid DESC
+                        LIMIT 100
+                    )
+                '''
 
-            sets.append(Item(facts=facts))
+            cs_sql += '''
+                AND f.dbid != f.changeset
+                ORDER BY f.tag ASC, f.prop ASC, f.val ASC, f.dbid ASC, f.changeset DESC
+            '''
+
+            sets: List[Item] = []
+            for row in cur.execute(cs_sql, cs_params):
+                if not ref:
+                    desc = f'@{row["ref"]}: '
+                else:
+                    desc = ''
+                desc += 'Added ' if not row["revoke"] else 'Revoked '
+                desc += repr(self._fact_from_row(row))
+                facts = {
+                    Ref(row["tx_ref"]),
+                    Content(desc),
+                    Value('_db', 'created', row["tx_created"])
+                }
 
-        return sets
+                sets.append(Item(facts=facts))
+
+            return sets
 
     def _get_last_ingested_changeset(self, dbuuid: str) -> int:
-        cur = self._conn.cursor()
-        cs = cur.execute('SELECT MAX(origin_rowid) AS max FROM changesets WHERE origin = ? GROUP BY origin', (dbuuid,)).fetchone()
-        return 0 if not cs else int(cs["max"])
+        with self._reader() as conn:
+            cur = conn.cursor()
+            cs = cur.execute('SELECT MAX(origin_rowid) AS max FROM changesets WHERE origin = ? GROUP BY origin', (dbuuid,)).fetchone()
+            return 0 if not cs else int(cs["max"])
 
     def _get_unreplicated_changesets(self) -> List[ChangeSet]:
-        cur = self._conn.cursor()
-        res = cur.execute('SELECT uuid, client, created, query, changes, origin, rowid AS origin_rowid, applied, replicated FROM changesets WHERE origin = ? AND applied = 1 AND (replicated = 0 OR replicated IS NULL) ORDER BY rowid', (self.uuid,))
-        changesets = []
-        for row in res:
-            changesets.append(self._changset_from_row(row))
-        return changesets
+        with self._reader() as conn:
+            cur = conn.cursor()
+            res = cur.execute('SELECT uuid, client, created, query, changes, origin, rowid AS origin_rowid, applied, replicated FROM changesets WHERE origin = ? AND applied = 1 AND (replicated = 0 OR replicated IS NULL) ORDER BY rowid', (self.uuid,))
+            changesets = []
+            for row in res:
+                changesets.append(self._changset_from_row(row))
+            return changesets
 
     def _changset_from_row(self, row: sqlite3.Row) -> ChangeSet:
         rowid = row['origin_rowid']
@@ -369,21 +1038,27 @@ class SqliteStore(Store):
             origin_rowid=rowid,
             applied=bool(row["applied"]),
             replicated=bool(row["replicated"]),
-            changes=ChangeSet.changes_from_dict(json.loads(row["changes"]))
+            changes=self._changes_from_column(row["changes"]),
         )
         return changeset
 
+    def _changes_from_column(self, changes: Union[bytes, str]) -> List[Change]:
+        # Changesets recorded before the binary encoding hold JSON text
+        if isinstance(changes, bytes):
+            return decode_changes(changes)
+        return ChangeSet.changes_from_dict(json.loads(changes))
+
     def _fact_from_row(self, row: sqlite3.Row) -> Fact:
-        return Fact(tag=row["tag"], prop=row["prop"], value=row["val"], tx=row["tx_ref"] if "tx_ref" in row else None)
+        return Fact(tag=intern(row["tag"]), prop=intern(row["prop"]), value=row["val"], tx=row["tx_ref"] if "tx_ref" in row else None)
 
     def _update_changeset(self, changeset: ChangeSet, replicated: Optional[bool] = None, applied: Optional[bool] = None) -> None:
-        cur = self._conn.cursor()
-        if replicated is not None:
-            cur.execute('UPDATE changesets SET replicated = ? WHERE uuid = ?', (int(replicated), changeset.uuid))
-            if cur.rowcount != 1:
-                raise Exception(f"Unexpected result when updating changeset '{changeset.uuid}'")
-        if applied is not None:
-            cur.execute('UPDATE changesets SET applied = ? WHERE uuid = ?', (int(applied), changeset.uuid))
-            if cur.rowcount != 1:
-                raise Exception(f"Unexpected result when updating changeset '{changeset.uuid}'")
-        self._conn.commit()
+        with self._transaction():
+            cur = self._conn.cursor()
+            if replicated is not None:
+                cur.execute('UPDATE changesets SET replicated = ? WHERE uuid = ?', (int(replicated), changeset.uuid))
+                if cur.rowcount != 1:
+                    raise Exception(f"Unexpected result when updating changeset '{changeset.uuid}'")
+            if applied is not None:
+                cur.execute('UPDATE changesets SET applied = ? WHERE uuid = ?', (int(applied), changeset.uuid))
+                if cur.rowcount != 1:
+                    raise Exception(f"Unexpected result when updating changeset '{changeset.uuid}'")
@@ -5,7 +5,71 @@ import sys
 from typing import Any, Dict
 
 from jql.types import Content, fact_from_dict, Flag, has_flag, Item, Ref, Tag, Value
-from jql.store import Store
+from jql.store.refcodec import get_codec
+
+
+# Tokenizers to try for the content index, in order of preference. Trigram
+# indexes keep substring matching, unicode61 falls back to word prefixes.
+CONTENT_TOKENIZERS = ['trigram', 'unicode61']
+
+
+def build_live_facts(cur: sqlite3.Cursor) -> None:
+    cur.execute('''DELETE FROM live_facts''')
+    cur.execute('''
+                INSERT OR REPLACE INTO live_facts (dbid, ref, tag, prop, val, tx_ref, archived, created, is_tx)
+                SELECT f.dbid, i.ref, f.tag, f.prop, f.val, t.ref, i.archived, i.created, CASE WHEN i.changeset_uuid IS NOT NULL THEN 1 ELSE 0 END
+                    FROM facts f
+                    INNER JOIN idlist i
+                    ON i.rowid = f.dbid
+                    INNER JOIN idlist t
+                    ON t.rowid = f.changeset
+                    WHERE f.current = 1
+                    AND f.revoke = 0
+                    ORDER BY f.rowid
+    ''')
+
+
+def build_content_index(cur: sqlite3.Cursor) -> None:
+    cur.execute('''DELETE FROM content_index''')
+    cur.execute('''
+                INSERT INTO content_index (rowid, val)
+                SELECT dbid, val
+                    FROM live_facts
+                    WHERE tag = '_db'
+                    AND prop = 'content'
+                    AND is_tx = 0
+    ''')
+
+
+def build_tag_stats(cur: sqlite3.Cursor) -> None:
+    cur.execute('''DELETE FROM tag_stats''')
+    cur.execute('''
+                INSERT INTO tag_stats (tag, prop, count)
+                SELECT tag, '', COUNT(DISTINCT dbid)
+                    FROM live_facts
+                    WHERE archived = 0
+                    AND is_tx = 0
+                    GROUP BY tag
+                UNION ALL
+                SELECT tag, prop, COUNT(*)
+                    FROM live_facts
+                    WHERE archived = 0
+                    AND is_tx = 0
+                    AND prop != ''
+                    GROUP BY tag, prop
+    ''')
+
+
+def rebuild_derived_tables(cur: sqlite3.Cursor) -> None:
+    """
+    Rebuild live_facts, the content index and tag_stats from facts, after
+    facts have been changed directly
+    """
+    print('Rebuilding live_facts, content index and tag_stats')
+    build_live_facts(cur)
+    if cur.execute("SELECT name FROM sqlite_master WHERE name = 'content_index'").fetchone():
+        build_content_index(cur)
+    build_tag_stats(cur)
 
 
 def schema_migration(conn: sqlite3.Connection) -> None:
@@ -36,6 +100,8 @@ def schema_migration(conn: sqlite3.Connection) -> None:
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_idlist_ref ON idlist (ref)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_idlist_created ON idlist (created)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_idlist_archived ON idlist (archived)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_idlist_uuid ON idlist (uuid)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_idlist_changeset_uuid ON idlist (changeset_uuid)''')
 
     cur.execute('''
         CREATE TABLE IF NOT EXISTS
@@ -49,12 +115,41 @@ def schema_migration(conn: sqlite3.Connection) -> None:
             current int
         )
     ''')
-    cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_dbid ON facts (dbid)''')
+    # The composite index also serves dbid lookups, so idx_facts_dbid is redundant
+    cur.execute('''DROP INDEX IF EXISTS idx_facts_dbid''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_current_fact ON facts (dbid, tag, prop, current)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_as_of ON facts (dbid, tag, prop, changeset)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_tag ON facts (tag)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_prop ON facts (prop)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_current ON facts (current)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_revoke ON facts (revoke)''')
 
+    # Superseded and revoked facts moved out of facts by compaction. fid
+    # keeps the rowid the fact had in facts.
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS
+        facts_history (
+            fid INTEGER PRIMARY KEY,
+            changeset int,
+            dbid int,
+            tag text,
+            prop text,
+            val text,
+            revoke int,
+            current int
+        )
+    ''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_facts_history_as_of ON facts_history (dbid, tag, prop, changeset)''')
+    cur.execute('''
+                CREATE VIEW IF NOT EXISTS fact_log
+                AS
+                SELECT rowid AS fid, changeset, dbid, tag, prop, val, revoke, current
+                    FROM facts
+                UNION ALL
+                SELECT fid, changeset, dbid, tag, prop, val, revoke, current
+                    FROM facts_history
+    ''')
+
     cur.execute('''
         CREATE TABLE IF NOT EXISTS
         changesets (
@@ -66,7 +161,8 @@ def schema_migration(conn: sqlite3.Connection) -> None:
             origin text,
             origin_rowid int,
             applied int,
-            replicated int
+            replicated int,
+            hash text
         )
     ''')
     if current_version and current_version < 5:
@@ -80,6 +176,10 @@ def schema_migration(conn: sqlite3.Connection) -> None:
         cur.execute('''ALTER TABLE changesets ADD COLUMN applied int''')
         cur.execute('''ALTER TABLE changesets ADD COLUMN replicated int''')
 
+    if current_version and current_version < 19 and 'hash' not in {c['name'] for c in cur.execute('PRAGMA table_info(changesets)')}:
+        # Changes are now stored in a binary encoding, with a content hash
+        cur.execute('''ALTER TABLE changesets ADD COLUMN hash text''')
+
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_changesets_uuid ON changesets (uuid)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_changesets_origin ON changesets (origin)''')
     cur.execute('''CREATE INDEX IF NOT EXISTS idx_changesets_origin_rowid ON changesets (origin_rowid)''')
@@ -107,18 +207,69 @@ def schema_migration(conn: sqlite3.Connection) -> None:
                     FROM idlist
                     WHERE uuid IS NULL
     ''')
+
+    # Materialised copy of the current (non-revoked) facts, one row per
+    # dbid/tag/prop, kept up to date by the store as facts are added
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS
+        live_facts (
+            dbid int,
+            ref text,
+            tag text,
+            prop text,
+            val text,
+            tx_ref text,
+            archived int,
+            created timestamp,
+            is_tx int
+        )
+    ''')
+    cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_live_facts_fact ON live_facts (dbid, tag, prop)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_live_facts_ref ON live_facts (ref)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_live_facts_search ON live_facts (tag, prop, val)''')
+    cur.execute('''CREATE INDEX IF NOT EXISTS idx_live_facts_created ON live_facts (created, dbid)''')
+
+    if current_version and current_version < 12:
+        print('Building live_facts table')
+        build_live_facts(cur)
+
+    # Full-text index over item content, keyed by item dbid
+    if not cur.execute("SELECT name FROM sqlite_master WHERE name = 'content_index'").fetchone():
+        for tokenizer in CONTENT_TOKENIZERS:
+            try:
+                cur.execute(f'''CREATE VIRTUAL TABLE content_index USING fts5(val, tokenize='{tokenizer}')''')
+            except sqlite3.OperationalError as e:
+                print(f'Could not create {tokenizer} content index: {e}')
+                continue
+
+            print(f'Building {tokenizer} content index')
+            cur.execute('''DELETE FROM config WHERE key = 'content_index' ''')
+            cur.execute('''INSERT INTO config (key, val) VALUES ('content_index', ?)''', (tokenizer,))
+            build_content_index(cur)
+            break
+
+    # Count of live items for each tag (with an empty prop) and each tag/prop,
+    # kept up to date by the store so hints don't need to aggregate live_facts
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS
+        tag_stats (
+            tag text,
+            prop text,
+            count int
+        )
+    ''')
+    cur.execute('''CREATE UNIQUE INDEX IF NOT EXISTS idx_tag_stats_tag ON tag_stats (tag, prop)''')
+
+    if current_version and current_version < 16:
+        print('Building tag_stats table')
+        build_tag_stats(cur)
+
     cur.execute('''DROP VIEW IF EXISTS current_facts_inc_tx''')
     cur.execute('''
                 CREATE VIEW current_facts_inc_tx
                 AS
-                SELECT i.ref, f.dbid, f.tag, f.prop, f.val, t.ref as tx_ref, i.archived, i.created, CASE WHEN i.changeset_uuid IS NOT NULL THEN 1 ELSE 0 END AS is_tx
-                    FROM facts f
-                    INNER JOIN idlist i
-                    ON i.rowid = f.dbid
-                    INNER JOIN transactions t
-                    ON t.rowid = f.changeset
-                    WHERE f.current = 1
-                    AND f.revoke = 0
+                SELECT ref, dbid, tag, prop, val, tx_ref, archived, created, is_tx
+                    FROM live_facts
     ''')
     cur.execute('''
                 CREATE VIEW IF NOT EXISTS current_facts_inc_archived
@@ -135,25 +286,11 @@ def schema_migration(conn: sqlite3.Connection) -> None:
                     FROM current_facts_inc_archived
                     WHERE archived = 0
     ''')
-    cur.execute('''
-                CREATE TRIGGER IF NOT EXISTS archive_overriden_facts
-                AFTER INSERT
-                    ON facts
-                FOR EACH ROW
-                WHEN
-                    1 NOT IN (SELECT COUNT(rowid) FROM facts WHERE current = 1 AND dbid = new.dbid AND tag = new.tag AND prop = new.prop)
-                BEGIN
-                    UPDATE facts
-                    SET current = 0
-                    WHERE dbid = new.dbid
-                        AND rowid != new.rowid
-                        AND current = 1
-                        AND tag = new.tag
-                        AND prop = new.prop;
-                END
-    ''')
+    # Overridden facts are now marked as not current by the store once per
+    # batch of inserted facts, rather than by a trigger for each row
+    cur.execute('''DROP TRIGGER IF EXISTS archive_overriden_facts''')
 
-    cur.execute('''PRAGMA user_version = 11''')
+    cur.execute('''PRAGMA user_version = 19''')
 
     conn.commit()
 
@@ -173,6 +310,8 @@ def data_migration(conn: sqlite3.Connection) -> None:
     if 'salt' not in config or 'created' not in config:
         raise Exception('missing vital config')
 
+    codec = get_codec(config['salt'])
+
     # Get idlist
     idlist: Dict[str, Any] = {}
     uids = {}
@@ -184,10 +323,10 @@ def data_migration(conn: sqlite3.Connection) -> None:
         if not len(i['ref']):
             raise Exception('missing ref', dict(i))
 
-        if Store.ref_to_id(config['salt'], Ref(i['ref'])) != rowid:
+        if codec.decode(Ref(i['ref'])) != rowid:
             raise Exception('ref does not map to rowid')
 
-        if Store.id_to_ref(config['salt'], rowid) != Ref(i['ref']):
+        if codec.encode(rowid) != Ref(i['ref']):
             raise Exception('ref does not map to rowid')
 
         if not len(i['created']):
@@ -393,6 +532,10 @@ def data_migration(conn: sqlite3.Connection) -> None:
                 print('No _tx/origin found, so inserting!', cs_facts)
                 cur.execute('INSERT INTO facts (changeset, dbid, tag, prop, val, revoke, current) VALUES (?, ?, ?, ?, ?, ?, ?)', [cidl_rowid, cidl_rowid, '_tx', 'origin', origin, 0, 1])
 
+            # Binary encoded changes are always in the current format
+            if isinstance(c['changes'], bytes):
+                continue
+
             # Process changes
             changes = json.loads(c['changes'])
             updated_changes = []
@@ -404,7 +547,7 @@ def data_migration(conn: sqlite3.Connection) -> None:
                     if 'uid' in change and change['uid']:
                         change['uuid'] = change['uid']
                     elif change['ref']:
-                        srowid = Store.ref_to_id(c['origin'], Ref(change['ref']))
+                        srowid = get_codec(c['origin']).decode(Ref(change['ref']))
                         if change['ref'] == idlist[str(srowid)]['ref']:
                             suid = idlist[str(srowid)]['uuid']
                         else:
@@ -485,7 +628,7 @@ def data_migration(conn: sqlite3.Connection) -> None:
 
                 if fi['tag'] == 'db':
                     fi['tag'] = '_db'
-                    print('Updating to new style db tag', f)
+                    print('Updating to new style db tag', fi)
                     cur.execute('UPDATE facts SET tag = ?, prop = ? WHERE rowid = ?', [fi['tag'], fi['prop'], fi['rowid']])
 
                 if fi['tag'] == 'tx' or fi['tag'] == '_tx':
@@ -521,6 +664,10 @@ def data_migration(conn: sqlite3.Connection) -> None:
             if bool(archived) != found:
                 raise Exception('Archived flag doesn\'t match archived item state!', fs)
 
+        # The fixups above write to facts directly, so bring the tables
+        # derived from them back in step
+        rebuild_derived_tables(cur)
+
     except BaseException:
         raise
 
@@ -4,7 +4,7 @@ import os
 import structlog
 from typing import List, TYPE_CHECKING
 from pynamodb.models import Model
-from pynamodb.attributes import (UnicodeAttribute, NumberAttribute, UTCDateTimeAttribute)
+from pynamodb.attributes import (BinaryAttribute, UnicodeAttribute, NumberAttribute, UTCDateTimeAttribute)
 
 from jql.changeset import ChangeSet
 
@@ -21,7 +21,11 @@ class ReplicatedChangesets(Model):
     db_uuid = UnicodeAttribute(hash_key=True)
     changeset_rowid = NumberAttribute(range_key=True)
     received = UTCDateTimeAttribute()
-    content = UnicodeAttribute()
+    # JSON, as written before the binary encoding, and still read
+    content = UnicodeAttribute(null=True)
+    # Binary encoded changeset and its content hash
+    payload = BinaryAttribute(null=True, legacy_encoding=False)
+    content_hash = UnicodeAttribute(null=True)
 
 
 class Replicator:
@@ -45,18 +49,12 @@ class Replicator:
         task_log = self._log.bind(task='replicate_changeset', changeset=changeset)
         try:
             # Ship to dynamodb
-            replicate = {
-                'uuid': changeset.uuid,
-                'client': changeset.client,
-                'created': str(changeset.created),
-                'query': changeset.query,
-                'changes': changeset.changes_as_dict()
-            }
             rc = ReplicatedChangesets(
                 changeset.origin,
                 changeset.origin_rowid,
                 received=datetime.datetime.utcnow(),
-                content=json.dumps(replicate)
+                payload=changeset.to_bytes(),
+                content_hash=changeset.content_hash(),
             )
             rc.save()
             task_log.info('Replicated changeset successfully')
@@ -72,19 +70,26 @@ class Replicator:
         changesets = []
         try:
             for item in ReplicatedChangesets.query(store_uuid, ReplicatedChangesets.changeset_rowid > since):
-                content = json.loads(item.content)
-                changeset = ChangeSet(
-                    uuid=content['uuid'],
-                    origin=item.db_uuid,
-                    origin_rowid=int(item.changeset_rowid),
-                    client=content['client'],
-                    created=datetime.datetime.fromisoformat(content['created']),
-                    query=content['query'],
-                    changes=ChangeSet.changes_from_dict(content['changes'])
-                )
+                if item.payload:
+                    changeset = ChangeSet.from_bytes(item.payload)
+                    changeset.origin = item.db_uuid
+                    changeset.origin_rowid = int(item.changeset_rowid)
+                    if item.content_hash and changeset.content_hash() != item.content_hash:
+                        raise Exception(f'Changeset {changeset.uuid} does not match its content hash')
+                else:
+                    content = json.loads(item.content)
+                    changeset = ChangeSet(
+                        uuid=content['uuid'],
+                        origin=item.db_uuid,
+                        origin_rowid=int(item.changeset_rowid),
+                        client=content['client'],
+                        created=datetime.datetime.fromisoformat(content['created']),
+                        query=content['query'],
+                        changes=ChangeSet.changes_from_dict(content['changes'])
+                    )
 
                 changesets.append(changeset)
-                task_log.info(f'Loaded changeset {item.changeset_rowid} - {repr(content)}')
+                task_log.info(f'Loaded changeset {item.changeset_rowid} - {changeset.uuid}')
         except BaseException as e:
             task_log.exception(e)
 
@@ -9,7 +9,8 @@ if TYPE_CHECKING:
     from jql.client import Client
     from jql.store import Store
 
-from jql.parser import jql_parser, JqlTransformer
+from jql.parser import is_match, parse, split_script
+from jql.prepared import is_unbound_ref
 from jql.types import Item, Fact, Flag, is_ref, has_flag, Ref, Value
 from jql.changeset import Change, ChangeSet
 
@@ -39,8 +40,7 @@ class Transaction:
     def commit(self) -> None:
         if self.changeset:
             self.log.msg("tx.commit()", changeset=self.changeset)
-            cid = self._store.record_changeset(self.changeset)
-            self.add_response(self._store.apply_changeset(cid))
+            self.add_response(self._store.commit_changeset(self.changeset))
             self.closed = True
 
     def start(self) -> None:
@@ -102,17 +102,35 @@ class Transaction:
             raise Exception("Cannot find item")
         self._add_change(Change(uuid=uid, facts=facts))
 
-    def get_item(self, ref: Fact) -> None:
+    def set_matching(self, search: Iterable[Fact], facts: Iterable[Fact]) -> None:
+        if not facts:
+            raise Exception("No data supplied")
+        facts = set(facts)
         self.start()
-        self.log.msg("tx.get_item()", ref=ref)
-        self.add_response([self._get_item(ref)])
+        self.log.msg("tx.set_matching()", search=search, facts=facts)
+        for uid in self._store.get_matching_uuids(search):
+            self._add_change(Change(uuid=uid, facts=facts))
 
-    def get_items(self, search: Iterable[Fact]) -> None:
+    def revoke_matching(self, search: Iterable[Fact], facts: Iterable[Fact]) -> None:
+        if not facts:
+            raise Exception("No data supplied")
+        facts = set(facts)
+        self.start()
+        self.log.msg("tx.revoke_matching()", search=search, facts=facts)
+        for uid in self._store.get_matching_uuids(search):
+            self._add_change(Change(uuid=uid, facts=facts, revoke=True))
+
+    def get_item(self, ref: Fact, as_of: Optional[Fact] = None) -> None:
+        self.start()
+        self.log.msg("tx.get_item()", ref=ref, as_of=as_of)
+        self.add_response([self._get_item(ref, as_of=as_of)])
+
+    def get_items(self, search: Iterable[Fact], limit: Optional[int] = None, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> None:
         if not search:
             raise Exception("No search criteria supplied")
         self.start()
-        self.log.msg("tx.get_items()", search=search)
-        self.add_response(self._get_items(search))
+        self.log.msg("tx.get_items()", search=search, limit=limit, after=after, as_of=as_of)
+        self.add_response(self._get_items(search, limit=limit, after=after, as_of=as_of))
 
     def get_history(self, search: Optional[Fact] = None) -> None:
         self.start()
@@ -129,16 +147,38 @@ class Transaction:
         self.log.msg("tx.get_changesets()")
         self.add_response(self._store.get_changesets())
 
-    def _get_item(self, ref: Fact) -> Item:
+    def _get_item(self, ref: Fact, as_of: Optional[Fact] = None) -> Item:
         if not is_ref(ref):
             raise Exception("Not a ref")
-        item = self._store.get_item(ref)
+        item = self._store.get_item(ref, as_of=as_of)
         if not item:
             raise Exception(f'{ref} does not exist')
         return item
 
-    def _get_items(self, search: Iterable[Fact]) -> List[Item]:
-        return self._store.get_items(search)
+    def _get_items(self, search: Iterable[Fact], limit: Optional[int] = None, after: Optional[Fact] = None, as_of: Optional[Fact] = None) -> List[Item]:
+        return self._store.get_items(search, limit=limit, after=after, as_of=as_of)
+
+    def _split_modifiers(self, values: List[Fact]) -> Tuple[List[Fact], Optional[int], Optional[Fact], Optional[Fact]]:
+        # LIMIT, AFTER and AS OF are parsed as _db/limit, _db/after and
+        # _db/as_of (or _db/as_of_time) values
+        search = []
+        limit = None
+        after = None
+        as_of = None
+        for v in values:
+            if v.tag == '_db' and v.prop == 'limit':
+                limit = int(v.value)
+            elif v.tag == '_db' and v.prop == 'after':
+                after = Ref(v.value)
+            elif v.tag == '_db' and v.prop == 'as_of':
+                as_of = Ref(v.value)
+            elif v.tag == '_db' and v.prop == 'as_of_time':
+                as_of = self._store.get_tx_ref_as_of(v.value)
+                if not as_of:
+                    raise Exception(f'No transactions as of {v.value}')
+            else:
+                search.append(v)
+        return (search, limit, after, as_of)
 
     def trigger_replication(self) -> None:
         self.log.msg('tx.trigger_replication()')
@@ -148,15 +188,14 @@ class Transaction:
     def query_to_tree(self, query: str, log_errors: bool = True, replacements: Optional[List[Tuple[str, str]]] = None) -> Tuple[str, List[Fact]]:
         self.log = self.log.bind(query=query)
         try:
-            tree = jql_parser.parse(query)
+            action, parsed = parse(query)
         except lark.exceptions.UnexpectedInput as e:
             err = str(e).splitlines()[0]
             if log_errors:
                 self.log.error(err)
             raise Exception(f'Query error: {err}')
 
-        ast = JqlTransformer().transform(tree)
-        values: List[Fact] = [c for c in ast.children if isinstance(c, Fact)]
+        values: List[Fact] = list(parsed)
 
         # Replace any shortcuts
         if replacements:
@@ -166,11 +205,17 @@ class Transaction:
                     if v == Ref(str(s)):
                         self.log.info(f'Replaced {s} with {ref}')
                         new_values.append(Ref(ref))
+                    elif v.tag == '_db' and v.prop in ('after', 'as_of') and v.value == str(s):
+                        self.log.info(f'Replaced {s} with {ref}')
+                        new_values.append(Value('_db', v.prop, ref))
                     else:
                         new_values.append(v)
                 values = new_values
 
-        return (ast.data, values)
+        if any(is_unbound_ref(v) for v in values):
+            raise Exception('Query error: placeholders can only be used in prepared queries')
+
+        return (action, values)
 
     def q(self, query: str, tree: Optional[Tuple[str, List[Fact]]] = None) -> List[Item]:
         self.start()
@@ -182,28 +227,13 @@ class Transaction:
 
         action, values = tree
 
-        if action == 'create':
-            self.create_item(values)
-            self.commit()
-            return self.response
-
-        if action == 'archive':
-            self.set_facts(values[0], [Flag('_db', 'archived')])
-            self.commit()
-            return self.response
-
-        if action == 'set':
-            self.set_facts(values[0], values[1:])
-            self.commit()
-            return self.response
-
-        if action == 'del':
-            self.revoke_facts(values[0], values[1:])
+        if self._add_statement(action, values):
             self.commit()
             return self.response
 
         if action == 'get':
-            self.get_item(values[0])
+            ref, _, _, as_of = self._split_modifiers(values)
+            self.get_item(ref[0], as_of=as_of)
             return self.response
 
         if action == 'history':
@@ -211,7 +241,8 @@ class Transaction:
             return self.response
 
         if action == 'list':
-            self.get_items(values)
+            terms, limit, after, as_of = self._split_modifiers(values)
+            self.get_items(terms, limit=limit, after=after, as_of=as_of)
             return self.response
 
         if action == 'hints':
@@ -230,3 +261,47 @@ class Transaction:
             return self.response
 
         raise Exception(f"Unknown query '{query}'")
+
+    def script(self, script: str) -> List[Item]:
+        """
+        Run a script of CREATE, SET, DEL and ARCHIVE statements, separated by
+        newlines or semicolons, as a single changeset
+        """
+        self.start()
+        self.query = script
+        self.log.msg(f"Script '{script}'")
+
+        for statement in split_script(script):
+            action, values = self.query_to_tree(statement)
+            if not self._add_statement(action, values):
+                raise Exception(f"Only CREATE, SET, DEL and ARCHIVE can be used in scripts, not '{statement}'")
+
+        self.commit()
+        return self.response
+
+    def _add_statement(self, action: str, values: List[Fact]) -> bool:
+        """
+        Add the changes for a write statement, returns False if the action
+        isn't a write
+        """
+        if action == 'create':
+            self.create_item(values)
+        elif action in ('archive', 'set', 'del') and is_match(values[0]):
+            # Every item matching the search terms gets its own change
+            count = int(values[0].value)
+            search, data = values[1:count + 1], values[count + 1:]
+            if action == 'archive':
+                self.set_matching(search, [Flag('_db', 'archived')])
+            elif action == 'set':
+                self.set_matching(search, data)
+            else:
+                self.revoke_matching(search, data)
+        elif action == 'archive':
+            self.set_facts(values[0], [Flag('_db', 'archived')])
+        elif action == 'set':
+            self.set_facts(values[0], values[1:])
+        elif action == 'del':
+            self.revoke_facts(values[0], values[1:])
+        else:
+            return False
+        return True
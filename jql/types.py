@@ -1,4 +1,5 @@
 from __future__ import annotations
+from sys import intern
 from typing import Any, Callable, Iterable, Iterator, NamedTuple, Optional
 
 
@@ -49,13 +50,18 @@ class Fact(NamedTuple):
     def as_tuple(self) -> tuple[str, str, str]:
         return (self.tag, self.prop, self.value)
 
+    # tx isn't part of a fact's identity. Slicing compares and hashes the
+    # first three fields without going through the attribute lookups.
     def __eq__(self, other: Any) -> bool:
-        if not isinstance(other, self.__class__):
+        if not isinstance(other, Fact):
             return False
-        return self.as_tuple() == other.as_tuple()
+        return self[:3] == other[:3]
+
+    def __ne__(self, other: Any) -> bool:
+        return not self == other
 
     def __hash__(self) -> int:
-        return hash(self.as_tuple())
+        return hash(self[:3])
 
 
 def value_wrap(value: str) -> str:
@@ -87,16 +93,16 @@ def value_eq(value: str) -> Callable[[Fact], bool]:
 
 def has_prop(fact: Fact) -> bool:
     "Checks the fact has a prop set"
-    return not prop_eq("")(fact)
+    return require_fact(fact) and fact.prop != ""
 
 
 def has_value(fact: Fact) -> bool:
     "Checks the fact has a value set"
-    return not value_eq("")(fact)
+    return require_fact(fact) and fact.value != ""
 
 
 def is_hidden_sys(fact: Fact) -> bool:
-    return has_sys_tag(fact) and (is_tag(fact) or is_ref(fact) or prop_eq("content")(fact))
+    return has_sys_tag(fact) and (is_tag(fact) or fact.prop in ("id", "content"))
 
 
 def has_sys_tag(fact: Fact) -> bool:
@@ -111,27 +117,27 @@ def require_fact(fact: Fact) -> bool:
 
 
 def is_tag(fact: Fact) -> bool:
-    return prop_eq("")(fact) and value_eq("")(fact)
+    return require_fact(fact) and fact.prop == "" and fact.value == ""
 
 
 def is_prop(fact: Fact) -> bool:
-    return not prop_eq("")(fact)
+    return require_fact(fact) and fact.prop != ""
 
 
 def is_ref(fact: Fact) -> bool:
-    return prop_eq("id")(fact)
+    return require_fact(fact) and fact.prop == "id"
 
 
 def is_primary_ref(fact: Fact) -> bool:
-    return is_ref(fact) and has_sys_tag(fact)
+    return is_ref(fact) and fact.tag.startswith('_')
 
 
 def is_content(fact: Fact) -> bool:
-    return has_sys_tag(fact) and prop_eq("content")(fact)
+    return has_sys_tag(fact) and fact.prop == "content"
 
 
 def is_created(fact: Fact) -> bool:
-    return has_sys_tag(fact) and prop_eq("created")(fact)
+    return has_sys_tag(fact) and fact.prop == "created"
 
 
 def is_flag(fact: Fact) -> bool:
@@ -170,17 +176,48 @@ def Content(value: str) -> Fact:
 
 
 def fact_from_dict(f: dict[str, str]) -> Fact:
-    return Fact(tag=f['tag'], prop=f.get('prop', ''), value=f.get('value', ''))
+    return Fact(tag=intern(f['tag']), prop=intern(f.get('prop', '')), value=f.get('value', ''))
 
 
 class Item:
     """
-    An item is a group of facts at a point in time
+    An item is a group of facts at a point in time.
+
+    Facts are indexed by tag and by (tag, prop) the first time an accessor
+    needs them, so lookups like get_content() and has_flag() don't scan
+    every fact.
     """
+    __slots__ = ('facts', '_by_tag', '_by_key')
     facts: frozenset[Fact]
+    _by_tag: Optional[dict[str, list[Fact]]]
+    _by_key: Optional[dict[tuple[str, str], list[Fact]]]
 
     def __init__(self, facts: Iterable[Fact]):
         super().__setattr__("facts", frozenset(facts))
+        super().__setattr__("_by_tag", None)
+        super().__setattr__("_by_key", None)
+
+    def _index(self) -> tuple[dict[str, list[Fact]], dict[tuple[str, str], list[Fact]]]:
+        by_tag: dict[str, list[Fact]] = {}
+        by_key: dict[tuple[str, str], list[Fact]] = {}
+        for f in self.facts:
+            by_tag.setdefault(f.tag, []).append(f)
+            by_key.setdefault((f.tag, f.prop), []).append(f)
+        super().__setattr__("_by_tag", by_tag)
+        super().__setattr__("_by_key", by_key)
+        return (by_tag, by_key)
+
+    def by_tag(self) -> dict[str, list[Fact]]:
+        by_tag = self._by_tag
+        if by_tag is None:
+            by_tag, _ = self._index()
+        return by_tag
+
+    def by_key(self) -> dict[tuple[str, str], list[Fact]]:
+        by_key = self._by_key
+        if by_key is None:
+            _, by_key = self._index()
+        return by_key
 
     def __str__(self) -> str:
         output: list[str] = []
@@ -216,6 +253,8 @@ def get_facts(item: Facts) -> Facts:
 
 
 def get_all_tags(item: Facts) -> Facts:
+    if isinstance(item, Item):
+        return {Tag(tag) for tag in item.by_tag()}
     return {Tag(f.tag) for f in item}
 
 
@@ -238,6 +277,8 @@ def get_flags(item: Facts, for_tag: str = '') -> Facts:
 
 
 def get_fact(item: Facts, tag: str, prop: str) -> Fact:
+    if isinstance(item, Item):
+        return single(item.by_key().get((tag, prop), []))
     return single((f for f in item if tag_eq(tag)(f) and prop_eq(prop)(f)))
 
 
@@ -249,10 +290,14 @@ def get_value(item: Facts, tag: str, prop: str) -> str:
 
 
 def has_flag(item: Facts, tag: str, prop: str) -> bool:
-    return len({f for f in item if tag_eq(tag)(f) and prop_eq(prop)(f)}) >= 1
+    if isinstance(item, Item):
+        return (tag, prop) in item.by_key()
+    return any(f.tag == tag and f.prop == prop for f in item if require_fact(f))
 
 
 def has_tag(item: Facts, tag: str) -> bool:
+    if isinstance(item, Item):
+        return tag in item.by_tag()
     return tag in {f.tag for f in item}
 
 
@@ -265,7 +310,12 @@ def revoke_item_facts(item: Item, revoke: Iterable[Fact]) -> Item:
 
 
 def has_ref(item: Item) -> bool:
-    return next(filter(is_primary_ref, item.facts), None) is not None
+    return len(_sys_facts(item, "id")) > 0
+
+
+def _sys_facts(item: Item, prop: str) -> list[Fact]:
+    "Facts with the supplied prop under any system tag, from the item's index"
+    return [f for (tag, p), facts in item.by_key().items() if p == prop and tag.startswith('_') for f in facts]
 
 
 def single(facts: Iterable[Fact]) -> Fact:
@@ -284,7 +334,7 @@ def is_archived(item: Facts) -> bool:
 
 
 def get_ref(item: Facts) -> Fact:
-    f = list(filter(is_primary_ref, item))
+    f = _sys_facts(item, "id") if isinstance(item, Item) else list(filter(is_primary_ref, item))
     if len(f) == 1:
         return f[0]
     elif len(f) == 0:
@@ -294,7 +344,7 @@ def get_ref(item: Facts) -> Fact:
 
 
 def get_content(item: Facts) -> Fact:
-    c = list(filter(is_content, item))
+    c = _sys_facts(item, "content") if isinstance(item, Item) else list(filter(is_content, item))
     if len(c) == 1:
         return c[0]
     elif len(c) == 0:
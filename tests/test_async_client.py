@@ -0,0 +1,32 @@
+import asyncio
+import pytest
+
+from jql.async_client import AsyncClient
+from jql.types import get_ref, Tag
+
+
+def test_async_read(db) -> None:
+    async def run() -> None:
+        async with AsyncClient(store=db.store, client="pytest:testuser") as client:
+            created = await asyncio.gather(*[client.read(f"CREATE item {i} #todo") for i in range(20)])
+            assert len(created) == 20
+
+            results = await asyncio.gather(*[client.read("#todo") for _ in range(10)])
+            assert all(len(r) == 20 for r in results)
+
+            ref = get_ref(created[0][0])
+            await client.read(f"@{ref.value} SET #done")
+            item = await client.get_item(ref)
+            assert item is not None and Tag('done') in item.facts
+            assert len(await client.get_items([Tag('done')])) == 1
+
+    asyncio.run(run())
+
+
+def test_async_errors_propagate(db) -> None:
+    async def run() -> None:
+        async with AsyncClient(store=db.store, client="pytest:testuser") as client:
+            await client.read("@fffffff")
+
+    with pytest.raises(Exception, match="does not exist"):
+        asyncio.run(run())
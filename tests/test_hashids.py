@@ -1,6 +1,10 @@
+from hashids import Hashids  # type: ignore
 import pytest
+import string
 
+from jql.store.refcodec import get_codec
 from jql.store.sqlite import SqliteStore
+from jql.types import Ref
 
 
 examples = [1, 2, 3, 5, 10, 35, 543, 1234, 5567, 87678]
@@ -21,3 +25,24 @@ def test_hash_conversions(test_int: int) -> None:
         assert ref.value not in hashes
         hashes.append(ref.value)
         assert s._ref_to_id(ref) == test_int
+
+
+def test_codec_matches_hashids() -> None:
+    hashids = Hashids(salt="testsalt", alphabet=string.hexdigits[:16], min_length=6)
+    codec = get_codec("testsalt")
+    for i in examples:
+        assert codec.encode(i) == Ref(hashids.encode(i))
+        assert codec.decode(Ref(hashids.encode(i))) == i
+
+
+def test_codec_shared_per_salt() -> None:
+    assert get_codec("testsalt") is get_codec("testsalt")
+    assert get_codec("testsalt") is not get_codec("testdiff")
+    assert SqliteStore(salt="testsalt")._codec is get_codec("testsalt")
+
+
+def test_codec_many() -> None:
+    codec = get_codec("testsalt")
+    refs = codec.encode_many(examples)
+    assert refs == [codec.encode(i) for i in examples]
+    assert codec.decode_many(refs) == examples
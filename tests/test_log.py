@@ -0,0 +1,138 @@
+import datetime
+import os
+import pytest
+from typing import Any, List
+import uuid
+
+from jql.changeset import Change, ChangeSet
+from jql.client import Client
+from jql.store.log import LogStore
+from jql.types import get_ref, Item, Tag, Value
+
+
+queries = [
+    "#todo",
+    "#chores",
+    "#chores/late=no",
+    "dish",
+    "HINTS",
+    "HISTORY",
+    "CHANGESETS",
+]
+
+
+def as_tuples(items: List[Item]) -> List[Any]:
+    return [i.as_tuples() for i in items]
+
+
+def populate(client: Client) -> Any:
+    client.read("CREATE do dishes #todo #chores")
+    ref = get_ref(client.read("CREATE groceries #chores/late=yes")[0])
+    client.read(f"{ref} SET #chores/late=no #todo")
+    archived = get_ref(client.read("CREATE archive me #todo #chores")[0])
+    client.read(f"{archived} ARCHIVE")
+    return ref
+
+
+def results(client: Client, ref: Any) -> List[Any]:
+    return [as_tuples(client.read(q)) for q in queries + [f"{ref}", f"{ref} HISTORY"]]
+
+
+def test_log_store_reopen(tmp_path) -> None:  # type: ignore
+    store = LogStore(str(tmp_path))
+    client = Client(store=store, client="pytest:testuser")
+    ref = populate(client)
+    expected = results(client, ref)
+    store.close()
+
+    reopened = LogStore(str(tmp_path))
+    assert reopened.uuid == store.uuid
+    client = Client(store=reopened, client="pytest:testuser")
+    assert results(client, ref) == expected
+
+    # Writes carry on from the end of the log
+    client.read(f"{ref} SET #more")
+    reopened.close()
+    client = Client(store=LogStore(str(tmp_path)), client="pytest:testuser")
+    assert Tag('more') in client.read(f"{ref}")[0].facts
+
+
+def test_log_store_replays_tx_items_exactly(tmp_path) -> None:  # type: ignore
+    def tx_items(client: Client) -> List[Any]:
+        # Every fact of the _tx items, including the hidden _db/created time
+        return sorted(sorted(f.as_tuple() for f in item.facts) for item in client.read("CHANGESETS"))
+
+    store = LogStore(str(tmp_path), checkpoint_interval=0)
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+    expected = tx_items(client)
+    store.close()
+
+    reopened = LogStore(str(tmp_path), checkpoint_interval=0)
+    assert tx_items(Client(store=reopened, client="pytest:testuser")) == expected
+    reopened.close()
+
+    reopened = LogStore(str(tmp_path), checkpoint_interval=0)
+    assert tx_items(Client(store=reopened, client="pytest:testuser")) == expected
+
+
+def test_log_store_checkpoint_and_segments(tmp_path) -> None:  # type: ignore
+    store = LogStore(str(tmp_path), segment_size=512, checkpoint_interval=3)
+    client = Client(store=store, client="pytest:testuser")
+    ref = populate(client)
+    client.read(f"{ref} SET #after")
+    expected = results(client, ref)
+    store.close()
+
+    names = os.listdir(tmp_path)
+    assert 'checkpoint.pickle' in names
+    assert len([n for n in names if n.startswith('segment-')]) > 1
+
+    client = Client(store=LogStore(str(tmp_path), segment_size=512), client="pytest:testuser")
+    assert results(client, ref) == expected
+
+
+def test_log_store_drops_torn_transaction(tmp_path) -> None:  # type: ignore
+    store = LogStore(str(tmp_path))
+    client = Client(store=store, client="pytest:testuser")
+    ref = populate(client)
+    expected = results(client, ref)
+    store.close()
+
+    segment = os.path.join(tmp_path, 'segment-00000001.log')
+    with open(segment, 'ab') as f:
+        f.write(b'[{"op":"record","chan')
+
+    store = LogStore(str(tmp_path))
+    client = Client(store=store, client="pytest:testuser")
+    assert results(client, ref) == expected
+    client.read("CREATE after crash #todo")
+    store.close()
+
+    client = Client(store=LogStore(str(tmp_path)), client="pytest:testuser")
+    assert len(client.read("#todo")) == 3
+
+
+def test_log_store_failed_changeset_not_applied(tmp_path) -> None:  # type: ignore
+    store = LogStore(str(tmp_path))
+    client = Client(store=store, client="pytest:testuser")
+    client.read("CREATE do dishes #todo")
+
+    changeset = ChangeSet(
+        uuid=str(uuid.uuid4()),
+        client='pytest:testuser',
+        origin=store.uuid,
+        origin_rowid=0,
+        created=datetime.datetime.now(),
+        query='',
+        changes=[Change(uuid=str(uuid.uuid4()), facts={Value('_db', 'created', str(datetime.datetime.now())), Tag('todo')}), Change(uuid='missing', facts={Tag('new')})]
+    )
+    store.record_changeset(changeset)
+    with pytest.raises(Exception, match='Could not find item'):
+        store.apply_changeset(changeset.uuid)
+    store.close()
+
+    reopened = LogStore(str(tmp_path))
+    client = Client(store=reopened, client="pytest:testuser")
+    assert len(client.read("#todo")) == 1
+    assert not reopened._load_changeset(changeset.uuid).applied
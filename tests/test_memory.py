@@ -0,0 +1,58 @@
+from typing import Any, List
+
+from jql.client import Client
+from jql.store.memory import MemoryStore
+from jql.store.sqlite import SqliteStore
+from jql.types import get_ref, Item
+
+
+queries = [
+    "#todo",
+    "#chores",
+    "#chores/late",
+    "#chores/late=no",
+    "dish",
+    "LAWN",
+    "#todo LIMIT 2",
+    "HINTS",
+    "HINTS #ch",
+    "HINTS #chores/",
+    "HISTORY",
+]
+
+
+def as_tuples(items: List[Item]) -> List[Any]:
+    return [i.as_tuples() for i in items]
+
+
+def test_memory_store_matches_sqlite() -> None:
+    clients = [Client(store=SqliteStore(salt="testsalt"), client="pytest:testuser"), Client(store=MemoryStore(salt="testsalt"), client="pytest:testuser")]
+    sqlite, memory = clients
+
+    # Replay the same changesets so refs and timestamps line up
+    sqlite.read("CREATE do dishes #todo #chores")
+    ref = get_ref(sqlite.read("CREATE groceries #chores/late=yes")[0])
+    sqlite.read("CREATE mow lawns #todo")
+    sqlite.read(f"{ref} SET #chores/late=no #todo")
+    archived = get_ref(sqlite.read("CREATE archive me #todo #chores")[0])
+    sqlite.read(f"{archived} ARCHIVE")
+    sqlite.read(f"{ref} DEL #chores/late")
+    memory.store.apply_changesets_bulk(sqlite.store._get_unreplicated_changesets())
+
+    for query in queries + [f"{ref}", f"{ref} HISTORY", f"#todo AFTER {ref}"]:
+        assert as_tuples(memory.read(query)) == as_tuples(sqlite.read(query)), query
+
+
+def test_memory_store_indexes_follow_archive() -> None:
+    client = Client(store=MemoryStore(), client="pytest:testuser")
+    ref = get_ref(client.read("CREATE do dishes #todo/priority=1")[0])
+    client.read(f"{ref} ARCHIVE")
+
+    store = client.store
+    assert isinstance(store, MemoryStore)
+    assert store._by_tag.get('todo') is None
+    assert store._content == {}
+
+    client.read(f"{ref} DEL #_db/archived")
+    assert len(client.read("#todo/priority=1")) == 1
+    assert len(client.read("dishes")) == 1
@@ -1,7 +1,9 @@
+from lark.exceptions import UnexpectedInput
 import pytest
+import random
 from typing import Any, List
 
-from jql.parser import jql_parser, JqlTransformer
+from jql.parser import jql_parser, JqlTransformer, parse, parse_lark, parse_simple
 from jql.types import Content, Flag, Ref, Tag, Value
 
 
@@ -70,6 +72,70 @@ examples = [
         "#todo/remind_at=444",
         ["list", [Value("todo", "remind_at", "444")]]
     ],
+    [
+        "#todo LIMIT 10",
+        ["list", [Tag("todo"), Value("_db", "limit", "10")]]
+    ],
+    [
+        "dishes #todo LIMIT 10 AFTER @4af",
+        ["list", [Content("dishes"), Tag("todo"), Value("_db", "limit", "10"), Value("_db", "after", "4af")]]
+    ],
+    [
+        "#todo AFTER @4af",
+        ["list", [Tag("todo"), Value("_db", "after", "4af")]]
+    ],
+    [
+        "@4af AS OF @d2a",
+        ["get", [Ref("4af"), Value("_db", "as_of", "d2a")]]
+    ],
+    [
+        "#todo LIMIT 10 AS OF 2021-04-12T10:30",
+        ["list", [Tag("todo"), Value("_db", "limit", "10"), Value("_db", "as_of_time", "2021-04-12 10:30")]]
+    ],
+    [
+        "CREATE as of today AS OF yesterday",
+        ["create", [Content("as of today AS OF yesterday")]]
+    ],
+    [
+        "CREATE happened AS OF 2020 maybe",
+        ["create", [Content("happened AS OF 2020 maybe")]]
+    ],
+    [
+        "@4af SET happened AS OF 2020-01-01",
+        ["set", [Ref("4af"), Content("happened AS OF 2020-01-01")]]
+    ],
+    [
+        "happened AS OF 2020 maybe",
+        ["list", [Content("happened AS OF 2020 maybe")]]
+    ],
+    [
+        "happened AS OF 2021-04-12 10:30",
+        ["list", [Content("happened"), Value("_db", "as_of_time", "2021-04-12 10:30")]]
+    ],
+    [
+        "speed LIMIT sign",
+        ["list", [Content("speed LIMIT sign")]]
+    ],
+    [
+        "CREATE speed LIMIT 50 zone",
+        ["create", [Content("speed LIMIT 50 zone")]]
+    ],
+    [
+        "CREATE speed LIMIT 50",
+        ["create", [Content("speed LIMIT 50")]]
+    ],
+    [
+        "@4af SET [[[meet AFTER @3af]]]",
+        ["set", [Ref("4af"), Content("meet AFTER @3af")]]
+    ],
+    [
+        "speed LIMIT 50 zone",
+        ["list", [Content("speed LIMIT 50 zone")]]
+    ],
+    [
+        "speed zone LIMIT 50 AFTER @4af",
+        ["list", [Content("speed zone"), Value("_db", "limit", "50"), Value("_db", "after", "4af")]]
+    ],
     [
         "HINTS",
         ["hints", []]
@@ -137,6 +203,10 @@ failure_examples = [
     'CREATE #help This is me',
     # can't start a quoted content n not finish
     'CREATE [[[ here is some content thats unfinished',
+    # paging only applies to lists
+    'CREATE dishes #todo LIMIT 10',
+    '#todo LIMIT ten',
+    '#todo AFTER @4af LIMIT 10',
 ]
 
 
@@ -151,11 +221,62 @@ def test_parser(test: List[Any]) -> None:
     assert ast.children == result
 
 
+@pytest.mark.parametrize("test", examples)
+def test_parse(test: List[Any]) -> None:
+    query, (action, result) = test
+    assert parse(query) == (action, tuple(result))
+
+
+def test_simple_parse_matches_lark() -> None:
+    rng = random.Random(1234)  # noqa: S311
+    fragments = [
+        '#todo', '#_db', '#a1', '#todo/done', '#todo/due_at', '#x/y2', '#_db/archived',
+        '@', '@3af', '@?', 'abc', '#', '/', '/late', '=', '=yes', '#Todo', '#to_do',
+        '#1a', ' ', ' ', '  ', '\t', '\n', '\r', '\f', 'LIMIT 5', 'SET', 'HINTS',
+    ]
+    fast = 0
+    for _ in range(3000):
+        query = ''.join(rng.choice(fragments) for _ in range(rng.randint(1, 6)))
+        simple = parse_simple(query)
+        try:
+            expected = parse_lark(query)
+        except Exception:
+            assert simple is None, query
+            continue
+        if simple is not None:
+            fast += 1
+            assert simple == expected, query
+    assert fast > 100
+
+
+def test_parse_cache() -> None:
+    parse.cache_clear()
+    assert parse("HINTS #to") == ("hints", (Tag("to"),))
+    assert parse("HINTS #to") is parse("HINTS #to")
+    assert parse.cache_info().hits == 2
+
+    with pytest.raises(UnexpectedInput, match='Unexpected token'):
+        parse("#todo LIMIT ten")
+    assert parse.cache_info().currsize == 1
+
+
 @pytest.mark.parametrize("test", failure_examples)
 def test_parser_fails(test: str) -> None:
 
-    with pytest.raises(Exception):
+    with pytest.raises(UnexpectedInput, match='Unexpected'):
         res = jql_parser.parse(test)
         # We only show printed output if the parser doesn't throw
         # an exception like we are expecting
         print(res)
+
+
+@pytest.mark.parametrize("query", [
+    '#todo #_db/limit',
+    '#todo #_db/limit=5',
+    '#todo #_db/match=1 SET #done',
+    '@4af SET #_db/as_of=4af',
+    'CREATE #_db/after=4af',
+])
+def test_parser_rejects_reserved(query: str) -> None:
+    with pytest.raises(Exception, match='is reserved'):
+        parse(query)
@@ -0,0 +1,30 @@
+import pytest
+
+from jql.types import Content, get_ref, Tag, Value
+
+
+def test_prepared_queries(db) -> None:
+    create = db.client.prepare("CREATE ? #todo")
+    set_due = db.client.prepare("@? SET #todo/due=?")
+    get = db.client.prepare("@?")
+    assert set_due.placeholders == 2
+
+    ref = get_ref(create.execute("do dishes #not_a_tag")[0])
+    set_due.execute(ref, "tomorrow [[[quoted]]]")
+    item = get.execute(f"@{ref.value}")[0]
+    assert Content("do dishes #not_a_tag") in item.facts
+    assert Value("todo", "due", "tomorrow [[[quoted]]]") in item.facts
+    assert Tag("not_a_tag") not in item.facts
+
+    page = db.client.prepare("#todo LIMIT 1 AFTER @?")
+    other = get_ref(create.execute("mow lawns")[0])
+    assert [get_ref(i) for i in page.execute(ref)] == [other]
+
+
+def test_prepared_query_errors(db) -> None:
+    set_due = db.client.prepare("@? SET #todo/due=?")
+    with pytest.raises(Exception, match='expects 2 values'):
+        set_due.execute("abc")
+
+    with pytest.raises(Exception, match='prepared queries'):
+        db.q("@? SET #todo")
@@ -0,0 +1,428 @@
+import datetime
+import json
+import pytest
+import sqlite3
+import threading
+from typing import Any, List, Set, Tuple
+
+from jql.client import Client
+from jql.store.sqlite import SqliteStore
+import jql.store.sqlite_migration
+from jql.types import get_ref, Item
+
+
+def live_facts(conn: sqlite3.Connection) -> Set[Tuple[str, str, str, str, int, int]]:
+    return {tuple(r) for r in conn.execute('SELECT ref, tag, prop, val, archived, is_tx FROM live_facts')}  # type: ignore
+
+
+def rebuilt_live_facts(conn: sqlite3.Connection) -> Set[Tuple[str, str, str, str, int, int]]:
+    return {tuple(r) for r in conn.execute('''
+        SELECT i.ref, f.tag, f.prop, f.val, i.archived, CASE WHEN i.changeset_uuid IS NOT NULL THEN 1 ELSE 0 END
+        FROM facts f
+        INNER JOIN idlist i
+        ON i.rowid = f.dbid
+        WHERE f.current = 1
+        AND f.revoke = 0
+    ''')}  # type: ignore
+
+
+def populate(client: Client) -> None:
+    client.read("CREATE do dishes #todo #chores")
+    ref = client.read("CREATE groceries #chores/late=yes")[0]
+    client.read("CREATE mow lawns #todo")
+    client.read(f"{get_ref(ref)} SET #chores/late=no #todo")
+    client.read("#todo")
+
+
+def test_live_facts_match_fact_log() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    item = client.read("CREATE archive me #todo")[0]
+    ref = get_ref(item)
+    client.read(f"{ref} DEL #todo")
+    client.read(f"{ref} ARCHIVE")
+
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+
+
+def test_live_facts_migration() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    expected = live_facts(store._conn)
+
+    # Pretend we are an older database without the materialised table
+    store._conn.execute('DELETE FROM live_facts')
+    store._conn.execute('PRAGMA user_version = 11')
+    store._conn.commit()
+
+    jql.store.sqlite_migration.schema_migration(store._conn)
+    assert live_facts(store._conn) == expected
+
+
+def test_unarchive() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+
+    item = client.read("CREATE do dishes #todo")[0]
+    ref = get_ref(item)
+
+    client.read(f"{ref} ARCHIVE")
+    assert client.read("#todo") == []
+
+    client.read(f"{ref} DEL #_db/archived")
+    assert len(client.read("#todo")) == 1
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+
+
+def content_index(conn: sqlite3.Connection) -> Set[Tuple[int, str]]:
+    return {tuple(r) for r in conn.execute('SELECT rowid, val FROM content_index')}  # type: ignore
+
+
+def live_content(conn: sqlite3.Connection) -> Set[Tuple[int, str]]:
+    return {tuple(r) for r in conn.execute("SELECT dbid, val FROM live_facts WHERE tag = '_db' AND prop = 'content' AND is_tx = 0")}  # type: ignore
+
+
+def test_content_index_maintained() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    assert store._content_index == 'trigram'
+
+    ref = get_ref(client.read("CREATE do dishes for batman #todo")[0])
+    client.read("CREATE tears for bATman #chores")
+    assert len(client.read("BATMAN")) == 2
+
+    client.read(f"{ref} SET wash the car")
+    assert len(client.read("batman")) == 1
+    assert len(client.read("car")) == 1
+    assert len(client.read("wash the")) == 1
+
+    client.read(f"{ref} DEL #_db/content")
+    assert len(client.read("car")) == 0
+
+    assert content_index(store._conn) == live_content(store._conn)
+
+
+def test_content_index_word_tokenizer(monkeypatch) -> None:  # type: ignore
+    monkeypatch.setattr(jql.store.sqlite_migration, 'CONTENT_TOKENIZERS', ['unicode61'])
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    assert store._content_index == 'unicode61'
+
+    client.read("CREATE do dishes for batman #todo")
+    assert len(client.read("dish")) == 1
+    assert len(client.read("DO BAT")) == 1
+    assert len(client.read("ishes")) == 0
+
+
+def test_content_index_migration() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    store._conn.execute('DROP TABLE content_index')
+    store._conn.execute('PRAGMA user_version = 12')
+    store._conn.commit()
+
+    jql.store.sqlite_migration.schema_migration(store._conn)
+    assert len(content_index(store._conn)) == 3
+    assert content_index(store._conn) == live_content(store._conn)
+
+
+def test_changeset_applied_in_one_transaction() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+
+    statements = []
+    store._conn.set_trace_callback(statements.append)
+    client.read("CREATE do dishes #todo #chores")
+    store._conn.set_trace_callback(None)
+
+    # One transaction to record the changeset, and one to apply it
+    assert statements.count('BEGIN IMMEDIATE') == 2
+    assert statements.count('COMMIT') == 2
+
+
+def test_bulk_apply_matches_fact_log() -> None:
+    source = Client(store=SqliteStore(), client="pytest:testuser")
+    populate(source)
+    ref = get_ref(source.read("CREATE archive me #todo")[0])
+    source.read(f"{ref} SET archived content")
+    source.read(f"{ref} ARCHIVE")
+
+    store = SqliteStore()
+    store.apply_changesets_bulk(source.store._get_unreplicated_changesets())
+
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+    assert content_index(store._conn) == live_content(store._conn)
+    assert store._conn.execute('SELECT COUNT(*) FROM facts WHERE current = 1').fetchone()[0] == source.store._conn.execute('SELECT COUNT(*) FROM facts WHERE current = 1').fetchone()[0]
+
+
+def test_wal_read_pool(tmp_path) -> None:  # type: ignore
+    store = SqliteStore(str(tmp_path / 'jql.db'), wal=True, read_pool_size=2)
+    client = Client(store=store, client="pytest:testuser")
+    assert store._conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+    populate(client)
+    assert len(client.read("#todo")) == 3
+    assert 0 < len(store._read_conns) <= 2
+
+    # Readers must not be able to write
+    try:
+        store._read_conns[0].execute("DELETE FROM live_facts")
+        raise AssertionError('read connection accepted a write')
+    except sqlite3.OperationalError:
+        pass
+
+    # Reads see each committed write
+    client.read("CREATE wash car #todo")
+    assert len(client.read("#todo")) == 4
+    store.checkpoint('TRUNCATE')
+    store.close()
+
+
+def test_wal_concurrent_reads(tmp_path) -> None:  # type: ignore
+    store = SqliteStore(str(tmp_path / 'jql.db'), wal=True, read_pool_size=3)
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    errors = []
+
+    def read() -> None:
+        try:
+            for _ in range(20):
+                assert len(client.read("#todo")) >= 3
+        except Exception as e:
+            errors.append(e)
+
+    def write() -> None:
+        try:
+            for i in range(20):
+                client.read(f"CREATE task {i} #todo")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=read) for _ in range(4)] + [threading.Thread(target=write)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert len(store._read_conns) <= 3
+    assert len(client.read("#todo")) == 23
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+    store.close()
+
+
+def current_facts(conn: sqlite3.Connection) -> Set[int]:
+    return {r[0] for r in conn.execute('SELECT rowid FROM facts WHERE current = 1')}
+
+
+def latest_facts(conn: sqlite3.Connection) -> Set[int]:
+    return {r[0] for r in conn.execute('SELECT MAX(rowid) FROM facts GROUP BY dbid, tag, prop')}
+
+
+def test_superseded_facts_not_current() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    ref = get_ref(client.read("CREATE do dishes #todo/priority=1")[0])
+    client.read(f"{ref} SET #todo/priority=2 #chores")
+    client.read(f"{ref} SET #todo/priority=3")
+    client.read(f"{ref} DEL #chores")
+
+    assert store._conn.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'").fetchall() == []
+    assert current_facts(store._conn) == latest_facts(store._conn)
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+
+
+def tag_stats(conn: sqlite3.Connection) -> Set[Tuple[str, str, int]]:
+    return {tuple(r) for r in conn.execute('SELECT tag, prop, count FROM tag_stats')}  # type: ignore
+
+
+def rebuilt_tag_stats(conn: sqlite3.Connection) -> Set[Tuple[str, str, int]]:
+    return {tuple(r) for r in conn.execute('''
+        SELECT tag, '', COUNT(DISTINCT dbid) FROM live_facts WHERE archived = 0 AND is_tx = 0 GROUP BY tag
+        UNION ALL
+        SELECT tag, prop, COUNT(*) FROM live_facts WHERE archived = 0 AND is_tx = 0 AND prop != '' GROUP BY tag, prop
+    ''')}  # type: ignore
+
+
+def test_tag_stats_maintained() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    ref = get_ref(client.read("CREATE do dishes #todo/priority=1 #chores")[0])
+    client.read(f"{ref} SET #todo/priority=2 #home/room=kitchen")
+    client.read(f"{ref} DEL #chores")
+    assert tag_stats(store._conn) == rebuilt_tag_stats(store._conn)
+    assert ('home', 'room', 1) in tag_stats(store._conn)
+
+    client.read(f"{ref} ARCHIVE")
+    assert tag_stats(store._conn) == rebuilt_tag_stats(store._conn)
+    assert not any(t == 'home' for t, _, _ in tag_stats(store._conn))
+
+    client.read(f"{ref} DEL #_db/archived")
+    assert tag_stats(store._conn) == rebuilt_tag_stats(store._conn)
+
+    bulk = SqliteStore()
+    bulk.apply_changesets_bulk(store._get_unreplicated_changesets())
+    assert tag_stats(bulk._conn) == tag_stats(store._conn)
+
+
+def test_tag_stats_migration() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    expected = tag_stats(store._conn)
+    store._conn.execute('DROP TABLE tag_stats')
+    store._conn.execute('PRAGMA user_version = 15')
+    store._conn.commit()
+
+    jql.store.sqlite_migration.schema_migration(store._conn)
+    assert tag_stats(store._conn) == expected
+
+
+def as_tuples(items: List[Item]) -> List[Any]:
+    return [i.as_tuples() for i in items]
+
+
+def test_compact_keeps_history() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    ref = get_ref(client.read("CREATE do dishes #todo/priority=1 #home")[0])
+    client.read(f"{ref} SET #todo/priority=2")
+    old_tx = get_ref(client.read("CHANGESETS")[0])
+    client.read(f"{ref} SET #todo/priority=3")
+    client.read(f"{ref} DEL #home")
+
+    history = as_tuples(client.read(f"{ref} HISTORY"))
+    as_of = as_tuples(client.read(f"{ref} AS OF {old_tx}"))
+    listed = as_tuples(client.read(f"#todo/priority=2 AS OF {old_tx}"))
+    live = as_tuples(client.read("#todo"))
+
+    moved = store.compact(datetime.datetime.now() + datetime.timedelta(days=1))
+    assert moved > 0
+    assert store._conn.execute('SELECT COUNT(*) FROM facts_history').fetchone()[0] == moved
+    assert store._conn.execute('SELECT COUNT(*) FROM facts WHERE current = 0 OR revoke = 1').fetchone()[0] <= 1
+
+    assert as_tuples(client.read(f"{ref} HISTORY")) == history
+    assert as_tuples(client.read(f"{ref} AS OF {old_tx}")) == as_of
+    assert as_tuples(client.read(f"#todo/priority=2 AS OF {old_tx}")) == listed
+    assert as_tuples(client.read("#todo")) == live
+
+    # Writes after compaction supersede facts that stayed in facts
+    client.read(f"{ref} SET #todo/priority=4 #home")
+    assert current_facts(store._conn) == latest_facts(store._conn)
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+    assert len(client.read("#todo/priority=4")) == 1
+    assert len(client.read(f"#todo/priority=2 AS OF {old_tx}")) == 1
+
+
+def test_compact_respects_horizon() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    assert store.compact(datetime.datetime(2000, 1, 1)) == 0
+    assert store._conn.execute('SELECT COUNT(*) FROM facts_history').fetchone()[0] == 0
+
+
+def without_refs(items: List[Item]) -> List[Any]:
+    return sorted(sorted((f.tag, f.prop, f.value) for f in i.facts if not (f.tag == '_db' and f.prop == 'id')) for i in items)
+
+
+def test_snapshot_round_trip(tmp_path) -> None:  # type: ignore
+    source = Client(store=SqliteStore(), client="pytest:testuser")
+    populate(source)
+    archived = get_ref(source.read("CREATE archive me #todo")[0])
+    source.read(f"{archived} ARCHIVE")
+
+    path = str(tmp_path / 'snapshot.gz')
+    assert source.store.export_snapshot(path) == 4
+
+    store = SqliteStore()
+    assert store.load_snapshot(path, batch_size=3) == 4
+    replica = Client(store=store, client="pytest:testuser")
+    for query in ["#todo", "#chores", "#chores/late=no", "dishes", "HINTS"]:
+        assert without_refs(replica.read(query)) == without_refs(source.read(query)), query
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+    assert tag_stats(store._conn) == rebuilt_tag_stats(store._conn)
+
+    # Ingestion resumes after the last changeset in the snapshot
+    assert store.get_last_ingested_changeset(source.store.uuid) == 6
+    source.read("CREATE after snapshot #todo")
+    for cs in source.store._get_unreplicated_changesets():
+        if cs.origin_rowid > store.get_last_ingested_changeset(source.store.uuid):
+            store.apply_changeset(store.record_changeset(cs))
+    assert without_refs(replica.read("#todo")) == without_refs(source.read("#todo"))
+
+    with pytest.raises(Exception, match='empty store'):
+        store.load_snapshot(path)
+
+
+def test_legacy_json_changes() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+
+    expected = store._get_unreplicated_changesets()
+    row = store._conn.execute('SELECT changes, hash FROM changesets ORDER BY rowid LIMIT 1').fetchone()
+    assert isinstance(row['changes'], bytes)
+    assert row['hash'] == expected[0].content_hash()
+
+    # Changesets recorded before the binary encoding are still read
+    for cs in expected:
+        store._conn.execute('UPDATE changesets SET changes = ? WHERE uuid = ?', (json.dumps(cs.changes_as_dict()), cs.uuid))
+    store._conn.commit()
+    assert store._get_unreplicated_changesets() == expected
+
+
+def test_update_matches_batched() -> None:
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+    client.run_script("\n".join(f"CREATE bulk {i} #bulk #todo" for i in range(50)))
+
+    client.read("#bulk SET #todo/priority=2")
+    client.read("#bulk SET [[[relabelled]]]")
+    assert len(client.read("relabelled")) == 50
+    client.read("#bulk DEL #todo")
+    client.read("#todo/priority=2 ARCHIVE")
+
+    assert client.read("#bulk") == []
+    assert live_facts(store._conn) == rebuilt_live_facts(store._conn)
+
+
+def test_data_migration_refreshes_derived_tables(capsys) -> None:  # type: ignore
+    store = SqliteStore()
+    client = Client(store=store, client="pytest:testuser")
+    populate(client)
+    expected = {q: [i.as_tuples() for i in client.read(q)] for q in ["dishes", "#todo", "HINTS", "HINTS #chores"]}
+
+    # Pretend we are an old database, with old style db tags for content and
+    # transactions missing their _db/id, and none of the derived tables
+    conn = store._conn
+    conn.execute("UPDATE facts SET tag = 'db' WHERE tag = '_db' AND prop = 'content'")
+    conn.execute("DELETE FROM facts WHERE tag = '_db' AND prop = 'id' AND dbid IN (SELECT rowid FROM transactions)")
+    conn.execute('DELETE FROM live_facts')
+    conn.execute('DELETE FROM content_index')
+    conn.execute('DELETE FROM tag_stats')
+    conn.execute('PRAGMA user_version = 11')
+    conn.commit()
+
+    jql.store.sqlite_migration.schema_migration(conn)
+    jql.store.sqlite_migration.data_migration(conn)
+
+    assert live_facts(conn) == rebuilt_live_facts(conn)
+    assert not conn.execute("SELECT 1 FROM live_facts WHERE tag = 'db'").fetchone()
+    assert {q: [i.as_tuples() for i in client.read(q)] for q in expected} == expected
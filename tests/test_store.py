@@ -0,0 +1,320 @@
+import datetime
+import pytest
+import threading
+import uuid
+
+from jql.changeset import Change, ChangeSet, decode_changes, encode_changes
+from jql.client import Client
+from jql.types import Content, Flag, get_content, get_fact, get_ref, Tag, Value
+
+
+def make_changeset(db, changes) -> ChangeSet:  # type: ignore
+    return ChangeSet(
+        uuid=str(uuid.uuid4()),
+        client='pytest:testuser',
+        origin=db.store.uuid,
+        origin_rowid=0,
+        created=datetime.datetime.now(),
+        query='',
+        changes=changes
+    )
+
+
+def create_change(*facts) -> Change:  # type: ignore
+    return Change(uuid=str(uuid.uuid4()), facts={Value('_db', 'created', str(datetime.datetime.now())), *facts})
+
+
+def test_failed_changeset_is_rolled_back(db) -> None:
+    db.q("CREATE do dishes #todo")
+
+    changeset = make_changeset(db, [
+        create_change(Content('groceries'), Tag('todo')),
+        Change(uuid='missing', facts={Tag('new')}),
+    ])
+    cid = db.store.record_changeset(changeset)
+
+    with pytest.raises(Exception, match='Could not find item'):
+        db.store.apply_changeset(cid)
+
+    assert len(db.q("#todo")) == 1
+    assert len(db.q("CHANGESETS")) == 1
+    assert not db.store._load_changeset(cid).applied
+
+
+def test_bulk_apply(db) -> None:
+    db.q("CREATE do dishes #chores")
+    db.q("CREATE mow lawns #todo #chores")
+    ref = db.last_ref
+    db.q(f"{ref} DEL #todo")
+    db.q(f"{ref} SET #newtag #chores/late=yes")
+    db.q(f"{ref} SET #chores/late=no")
+    db.q("CREATE old news #chores #_db/archived")
+
+    changesets = db.store._get_unreplicated_changesets()
+    dest = Client(store=type(db.store)(), client="pytest:testuser")
+    assert dest.store.apply_changesets_bulk(changesets, batch_size=4) == (6, 6)
+
+    db.compare_results(db.q("#chores"), dest.read("#chores"))
+    db.compare_results(db.q("#chores/late=no"), dest.read("#chores/late=no"))
+    db.compare_results(db.q("lawns"), dest.read("lawns"))
+    db.compare_results(db.q("HINTS"), dest.read("HINTS"))
+    db.compare_results(db.q("CHANGESETS"), dest.read("CHANGESETS"))
+
+    # Transactions keep their original time, rather than the time of the replay
+    created = {get_fact(item, '_tx', 'uuid').value: get_fact(item, '_db', 'created').value for item in dest.read("CHANGESETS")}
+    assert created == {cs.uuid: str(cs.created) for cs in changesets}
+
+    # Replaying the same log skips changesets that were already recorded
+    assert dest.store.apply_changesets_bulk(changesets) == (0, 0)
+
+    # And normal writes carry on afterwards
+    dest.read("CREATE groceries #chores")
+    assert len(dest.read("#chores")) == 3
+
+
+def test_bulk_apply_rolls_back_batch(db) -> None:
+    changesets = [
+        make_changeset(db, [create_change(Content('groceries'), Tag('todo'))]),
+        make_changeset(db, [Change(uuid='missing', facts={Tag('new')})]),
+    ]
+
+    with pytest.raises(Exception, match='Could not find item'):
+        db.store.apply_changesets_bulk(changesets)
+
+    assert db.q("#todo") == []
+    assert not db.store.check_changeset_exists(changesets[0].uuid)
+
+
+def test_list_paging(db) -> None:
+    changeset = make_changeset(db, [create_change(Content(f'task {i}'), Tag('todo')) for i in range(250)])
+    db.store.apply_changeset(db.store.record_changeset(changeset))
+    db.q("CREATE not a todo #chores")
+
+    # Lists are only capped when a LIMIT is given
+    assert len(db.q("#todo")) == 250
+    assert len(db.q("#todo LIMIT 1000")) == 250
+    assert len(db.store.get_items([Tag('todo')])) == 250
+
+    first = db.q("#todo LIMIT 10")
+    assert [get_content(i).value for i in first] == [f'task {i}' for i in range(10)]
+
+    after = get_ref(first[-1]).value
+    second = db.q(f"#todo LIMIT 10 AFTER @{after}")
+    assert [get_content(i).value for i in second] == [f'task {i}' for i in range(10, 20)]
+
+    items = list(db.store.iter_items([Tag('todo')], page_size=30))
+    assert [get_content(i).value for i in items] == [f'task {i}' for i in range(250)]
+
+    # Items created while iterating don't shift pages already read
+    it = db.store.iter_items([Tag('todo')], page_size=100)
+    read = [next(it) for _ in range(150)]
+    db.q("CREATE one more #todo")
+    read.extend(it)
+    assert len(read) == 251
+    assert len({get_ref(i) for i in read}) == 251
+
+    with pytest.raises(Exception, match='does not exist'):
+        db.q("#todo AFTER @fffffff")
+
+
+def test_as_of(db) -> None:
+    def last_tx() -> str:
+        return get_ref(db.q("CHANGESETS")[0]).value
+
+    ref = get_ref(db.q("CREATE do dishes #todo/priority=1 #home")[0]).value
+    tx1 = last_tx()
+    db.q(f"@{ref} SET #todo/priority=2 #chores")
+    tx2 = last_tx()
+    db.q("CREATE groceries #chores")
+    db.q(f"@{ref} DEL #home")
+    db.q(f"@{ref} ARCHIVE")
+
+    item = db.q(f"@{ref} AS OF @{tx1}")[0]
+    assert Value('todo', 'priority', '1') in item.facts
+    assert Tag('chores') not in item.facts
+    assert Value('todo', 'priority', '2') in db.q(f"@{ref} AS OF @{tx2}")[0].facts
+
+    assert len(db.q(f"#home AS OF @{tx1}")) == 1
+    assert len(db.q(f"#chores AS OF @{tx1}")) == 0
+    assert len(db.q(f"#chores AS OF @{tx2}")) == 1
+    assert len(db.q(f"#todo/priority=1 AS OF @{tx1}")) == 1
+    assert len(db.q(f"#todo/priority=1 AS OF @{tx2}")) == 0
+    assert len(db.q(f"dishes AS OF @{tx2}")) == 1
+
+    # Archived and revoked facts drop out at the transaction that changed them
+    assert len(db.q("#chores")) == 1
+    assert len(db.q("#home")) == 0
+    assert len(db.q(f"#chores #todo AS OF @{tx2}")) == 1
+
+    now = str(datetime.datetime.now())
+    assert len(db.q(f"#chores AS OF {now}")) == 1
+    with pytest.raises(Exception, match='No transactions'):
+        db.q("#chores AS OF 2000-01-01")
+    with pytest.raises(Exception, match='is not a transaction'):
+        db.q(f"#chores AS OF @{ref}")
+
+
+def test_item_cache(db) -> None:
+    client = Client(store=type(db.store)(item_cache_size=2), client="pytest:testuser")
+    store = client.store
+    refs = [get_ref(client.read(f"CREATE item {i} #todo")[0]) for i in range(3)]
+
+    assert store.get_item(refs[0]) is store.get_item(refs[0])
+    assert store.item_cache_info()[:2] == (1, 1)
+
+    # Writes invalidate only the items they touch
+    store.get_item(refs[1])
+    client.read(f"@{refs[0].value} SET #done")
+    assert Tag('done') in store.get_item(refs[0]).facts
+    assert store.item_cache_info().misses == 3
+    store.get_item(refs[1])
+    assert store.item_cache_info().hits == 2
+
+    client.read(f"@{refs[1].value} ARCHIVE")
+    assert Flag('_db', 'archived') in store.get_item(refs[1]).facts
+
+    # Least recently used items are evicted
+    for ref in refs:
+        store.get_item(ref)
+    info = store.item_cache_info()
+    assert info.currsize == 2 and info.maxsize == 2
+    assert store.get_item(refs[2]) is not None
+    assert store.item_cache_info().hits == info.hits + 1
+
+    # Bulk applied changesets invalidate too
+    changeset = make_changeset(db, [Change(uuid=store._ref_to_uuid(refs[2]), facts={Tag('bulk')})])
+    assert store.apply_changesets_bulk([changeset]) == (1, 1)
+    assert Tag('bulk') in store.get_item(refs[2]).facts
+
+
+def test_script_is_one_changeset(db) -> None:
+    ref = get_ref(db.q("CREATE do dishes #todo")[0]).value
+    before = len(db.store.get_changesets())
+
+    items = db.client.run_script(f"""
+        CREATE groceries #todo #chores
+        CREATE [[[mow; the lawns]]] #todo; @{ref} SET #todo/priority=1
+        @{ref} SET #todo/priority=2
+
+        @{ref} DEL #todo/priority; @{ref} SET #todo/priority=3
+    """)
+    assert len(items) == 6
+    assert len(db.store.get_changesets()) == before + 1
+    assert len(db.q("#todo")) == 3
+    assert len(db.q("mow; the")) == 1
+
+    # Later changes to the same item win
+    assert Value('todo', 'priority', '3') in db.q(f"@{ref}")[0].facts
+
+    with pytest.raises(Exception, match='Only CREATE'):
+        db.client.run_script("CREATE one more #todo\n#todo")
+    assert len(db.q("#todo")) == 3
+
+
+def test_changeset_binary_encoding(db) -> None:
+    changeset = make_changeset(db, [
+        create_change(Content('groceries'), Tag('todo'), Value('todo', 'due', 'tomorrow')),
+        Change(uuid='other', facts={Tag('todo'), Content('ünïcode ' * 100)}, revoke=True),
+    ])
+    changeset.origin_rowid = 300
+
+    data = changeset.to_bytes()
+    assert ChangeSet.from_bytes(data) == changeset
+    assert decode_changes(encode_changes(changeset.changes)) == changeset.changes
+
+    # Fact order does not change the encoding
+    reordered = [Change(uuid=c.uuid, facts=set(reversed(list(c.facts))), revoke=c.revoke) for c in changeset.changes]
+    assert encode_changes(reordered) == encode_changes(changeset.changes)
+
+    # The hash is the same wherever the changeset is stored
+    moved = ChangeSet.from_bytes(data)
+    moved.origin_rowid = 1
+    assert moved.content_hash() == changeset.content_hash()
+    moved.changes[0].facts.add(Tag('other'))
+    assert moved.content_hash() != changeset.content_hash()
+
+    with pytest.raises(Exception, match='Unrecognised changeset encoding'):
+        ChangeSet.from_bytes(encode_changes(changeset.changes))
+
+
+def test_group_commit(db) -> None:
+    store = type(db.store)(group_commit_window=0.2)
+    client = Client(store=store, client='pytest:testuser')
+    groups = []
+    commit_group = store._commit_group
+
+    def counting_commit_group(group):  # type: ignore
+        groups.append(len(group))
+        commit_group(group)
+    store._commit_group = counting_commit_group  # type: ignore
+
+    barrier = threading.Barrier(9)
+    results = {}
+    errors = []
+
+    def create(i: int) -> None:
+        barrier.wait()
+        results[i] = client.read(f"CREATE item {i} #todo")
+
+    def fail() -> None:
+        barrier.wait()
+        try:
+            store.commit_changeset(make_changeset(client, [
+                create_change(Content('half done'), Tag('todo')),
+                Change(uuid='missing', facts={Tag('new')}),
+            ]))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=create, args=(i,)) for i in range(8)] + [threading.Thread(target=fail)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Every transaction gets its own response and changeset
+    assert len(groups) < 9
+    assert sum(groups) == 9
+    assert sorted(get_content(items[0]).value for items in results.values()) == [f'item {i}' for i in range(8)]
+    assert len(client.read("CHANGESETS")) == 8
+
+    # The failed changeset is rolled back on its own
+    assert len(errors) == 1 and 'Could not find item' in str(errors[0])
+    assert len(client.read("#todo")) == 8
+
+
+def test_update_matches(db) -> None:
+    for i in range(5):
+        db.q(f"CREATE task {i} #todo" + (" #chores" if i % 2 else ""))
+    db.q("CREATE unrelated #note")
+    before = len(db.store.get_changesets())
+
+    # Each matching item is updated in one changeset
+    items = db.q("#todo #chores SET #todo/priority=1 #urgent")
+    assert [get_content(item).value for item in items] == ['task 1', 'task 3']
+    assert len(db.store.get_changesets()) == before + 1
+    assert len(db.q("#urgent")) == 2
+    assert len(db.q("#todo/priority=1")) == 2
+
+    db.q("#todo SET #todo/done")
+    assert len(db.q("#todo/done")) == 5
+    assert len(db.q("#note/done")) == 0
+
+    db.q("#urgent DEL #urgent #todo/priority")
+    assert len(db.q("#urgent")) == 0
+    assert len(db.q("#todo/priority")) == 0
+    assert len(db.q("#todo")) == 5
+
+    db.q("#chores ARCHIVE")
+    assert [get_content(item).value for item in db.q("#todo")] == ['task 0', 'task 2', 'task 4']
+    assert db.q("HINTS #todo")[0].facts >= {Value('_db', 'count', '3')}
+
+    # Nothing matching is not an error
+    assert db.q("#missing SET #todo/done") == []
+    assert len(db.store.get_changesets()) == before + 4
+
+    # Match and paging markers can only come from the parser
+    with pytest.raises(Exception, match='is reserved'):
+        db.q("#todo #_db/match=1 SET #todo/done")
+    with pytest.raises(Exception, match='is reserved'):
+        db.q("#todo #_db/limit=1")
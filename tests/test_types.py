@@ -1,4 +1,4 @@
-from jql.types import Content, Flag, Value, Item, Ref, Tag, get_content, get_ref, get_tags, get_props, get_flags
+from jql.types import Content, Fact, Flag, Value, Item, Ref, Tag, get_all_tags, get_content, get_fact, get_ref, get_tags, get_props, get_flags, has_flag, has_ref, has_tag
 
 
 def test_content() -> None:
@@ -62,3 +62,24 @@ def test_tuples() -> None:
     assert m.as_tuples() == {("help", "", ""), ("me", "", ""), ("test", "passed", ""), ("test", "failed", "twice"), ("_db", "content", "here")}
 
     # andback
+
+
+def test_item_indexes_match_facts() -> None:
+    facts = [Ref("23"), Content("here"), Tag("todo"), Flag("todo", "done"), Value("todo", "due", "today"), Value("_db", "created", "2021")]
+    i = Item(facts)
+    assert has_flag(i, "todo", "done") and has_flag(facts, "todo", "done")
+    assert not has_flag(i, "todo", "missing")
+    assert has_tag(i, "todo") and not has_tag(i, "chores")
+    assert get_fact(i, "todo", "due") == get_fact(facts, "todo", "due")
+    assert get_all_tags(i) == get_all_tags(facts)
+    assert get_ref(i) == get_ref(facts)
+    assert get_content(Item([Tag("x")])) == Content("")
+    assert has_ref(i) and not has_ref(Item([Tag("x")]))
+
+
+def test_fact_equality_ignores_tx() -> None:
+    a = Fact("todo", "due", "today", tx="1a")
+    b = Value("todo", "due", "today")
+    assert a == b and hash(a) == hash(b) and not a != b
+    assert a != Value("todo", "due", "later")
+    assert a != ("todo", "due", "today", "1a")